@@ -0,0 +1,188 @@
+"""Generate accompaniment for recorded performances without the GUI.
+
+Every input file is played into a `ComposingContext` on a simulated clock, as fast as the CPU allows, and the auto instruments' notes are written to a midi file or rendered to a wav file.
+Files are spread across a process pool:
+
+    python src/accompany.py recordings/*.mid --output-dir backing --format wav
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import cpu_count, makedirs, path
+from sys import exit
+from time import perf_counter
+from wave import open as open_wave
+from zlib import crc32
+
+import store
+from input_trace import SimulatedClock
+from midi_file import read_midi_file
+from recorder import PerformanceRecorder, read_performance_log
+
+# the channel of the drums in general midi, it doesn't have any pitches to follow
+DRUM_CHANNEL = 9
+
+
+def read_performance(file_path: str):
+    """Yield the events of a midi file or a `PerformanceRecorder` log as `(time, status, data1, data2)` tuples."""
+    if file_path.lower().endswith((".mid", ".midi")):
+        return read_midi_file(file_path)
+    return read_performance_log(file_path)
+
+
+def accompany_file(
+    input_path: str,
+    output_path: str,
+    style: str = "basic",
+    bpm: int = 120,
+    channels: list[int] = None,
+    step: float = 0.005,
+) -> float:
+    """Generate the accompaniment for one performance and return how many seconds long it is.
+
+    The output is a wav file if `output_path` ends in `.wav`, and otherwise whatever `PerformanceRecorder` writes for that path.
+    Only notes on `channels` are followed, which defaults to every channel except the drums. Recordings made by the app have the accompaniment on other channels, so they should be read with `channels=[0]`.
+    """
+    # the audio engine is only imported here so that the main process doesn't need it
+    from app import ComposingContext
+    from synth import AudioManager
+
+    clock = SimulatedClock()
+    store.now = clock.now
+    # the same file always gets the same accompaniment
+    store.random.seed(crc32(input_path.encode()))
+    store.noise_random.seed(crc32(input_path.encode()))
+    store.audio_manager = AudioManager(output=False)
+    composing_context = ComposingContext(style)
+    composing_context.change_bpm(bpm - composing_context.bpm)
+
+    wave_file = None
+    if output_path.lower().endswith(".wav"):
+        wave_file = open_wave(output_path, "wb")
+        wave_file.setnchannels(1)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(store.audio_manager.sample_rate)
+    else:
+        # the instruments record every note they play
+        store.recorder = PerformanceRecorder(output_path)
+    audio_frames_due = 0.0
+
+    def advance(accompany: bool = True):
+        nonlocal audio_frames_due
+        if accompany:
+            composing_context.update()
+        if wave_file is not None:
+            audio_frames_due += step * store.audio_manager.sample_rate
+            wave_file.writeframes(store.audio_manager.render(int(audio_frames_due)))
+            audio_frames_due -= int(audio_frames_due)
+        clock.advance(step)
+
+    followed_channels = (
+        set(range(16)) - {DRUM_CHANNEL} if channels is None else set(channels)
+    )
+    sustain = False
+    sustained_notes = set()
+    try:
+        for time, status, data1, data2 in read_performance(input_path):
+            if status & 0x0F not in followed_channels:
+                continue
+            while clock.now() < time:
+                advance()
+            kind = status & 0xF0
+            if kind == 0x90 and data2 > 0:
+                # a sustained note that is played again is restarted
+                if data1 in sustained_notes:
+                    sustained_notes.remove(data1)
+                    composing_context.remove_note(data1)
+                composing_context.add_note(data1)
+            elif kind in (0x80, 0x90):
+                if sustain:
+                    sustained_notes.add(data1)
+                else:
+                    composing_context.remove_note(data1)
+            elif kind == 0xB0 and data1 == 64:
+                sustain = data2 >= 64
+                if not sustain:
+                    for note in sustained_notes:
+                        composing_context.remove_note(note)
+                    sustained_notes.clear()
+        # finish the measure that is playing
+        tick_length = 60 / composing_context.bpm / 4
+        measure_end = (
+            clock.now() + (16 - composing_context.tick_in_measure) * tick_length
+        )
+        while clock.now() < measure_end:
+            advance()
+        composing_context.release_all(clock.now())
+        # let the last notes ring out without starting new ones
+        end = clock.now() + 1
+        while clock.now() < end:
+            advance(accompany=False)
+    finally:
+        if wave_file is not None:
+            wave_file.close()
+        else:
+            store.recorder.stop()
+            store.recorder = None
+    return clock.now()
+
+
+def main():
+    parser = ArgumentParser(
+        description="Generate accompaniment for recorded performances."
+    )
+    parser.add_argument("inputs", nargs="+", help="midi files or recording logs")
+    parser.add_argument(
+        "--output-dir", default=".", help="where to write the accompaniment"
+    )
+    parser.add_argument("--format", choices=("mid", "wav"), default="mid")
+    parser.add_argument("--style", default="basic")
+    parser.add_argument("--bpm", type=int, default=120)
+    parser.add_argument(
+        "--channel",
+        type=int,
+        action="append",
+        help="only follow notes on this midi channel (0-15), can be given more than once",
+    )
+    parser.add_argument("--workers", type=int, default=cpu_count())
+    args = parser.parse_args()
+
+    makedirs(args.output_dir, exist_ok=True)
+    start = perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = {}
+        for input_path in args.inputs:
+            name = path.splitext(path.basename(input_path))[0]
+            output_path = path.join(
+                args.output_dir, f"{name}-accompaniment.{args.format}"
+            )
+            future = executor.submit(
+                accompany_file,
+                input_path,
+                output_path,
+                args.style,
+                args.bpm,
+                args.channel,
+            )
+            futures[future] = (input_path, output_path)
+        for done, future in enumerate(as_completed(futures), 1):
+            input_path, output_path = futures[future]
+            try:
+                duration = future.result()
+            except Exception as exception:
+                failed += 1
+                print(f"[{done}/{len(futures)}] {input_path} failed: {exception}")
+                continue
+            print(
+                f"[{done}/{len(futures)}] {input_path} -> {output_path} ({duration:.1f} s)"
+            )
+    print(
+        f"Accompanied {len(futures) - failed} of {len(futures)} files in {perf_counter() - start:.1f} s"
+    )
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,56 @@
 from abc import ABC, abstractmethod
 from csv import reader
+from heapq import heappop, heappush
 from math import floor
 from os import path
-from queue import Queue
-from random import random
-from threading import Event, Thread, Timer
-from time import sleep, time
+from threading import Thread
+from time import strftime
 
-from pygame import K_LEFT, K_RIGHT, KEYDOWN, KEYUP, MOUSEWHEEL
+import numpy as np
+from pygame import K_F5, K_F6, K_LEFT, K_RIGHT, KEYDOWN, KEYUP, MOUSEWHEEL
 from pygame import event as pygame_event
 
 import store
-from midi import MidiDeviceProcessor, Note
-from rendering import NoteBar, PianoKey
-from synth import AudioManager, InstrumentAudio, NoiseSynth, SineSynth, SquareSynth
-
-from ui import UiBase, UiButton, UiText
+from bounce import AudioBounce
+from chords import NOTE_NAMES, Chord, recognize_chord
+from events import BusEvent, EventKind
+from midi import MidiInputManager, Note
+from midi_file import MidiFilePlayer
+from patterns import STYLES
+from profiler import FrameProfiler
+from recorder import PerformanceRecorder
+from rendering import STEP, KeyIndex, PianoKey, PianoRoll
+from scope import AudioScope
+from synth import (
+    SCHEDULING_LATENCY,
+    AudioManager,
+    InstrumentAudio,
+    NoiseSynth,
+    SineSynth,
+    SquareSynth,
+)
+from tracer import trace_span
+
+from ui import UiBase, UiButton, UiProfilerOverlay, UiText, UiVisualiser
+
+# the note bars of each channel are drawn in the colour of the instrument that plays on it
+ROLL_INSTRUMENTS = {0: "piano", 1: "chords", 2: "bass", 9: "drums"}
 
 
 class Piano:
     """A piano is a collection of piano keys and a synthesizer."""
 
-    def __init__(self, length: int):
+    def __init__(self, length: int, midi_input: bool = True):
         # initialize 88 piano keys
         self._keys: list[PianoKey] = []
-        self._note_bars = []
         self._horizontal_scroll = 0.0
+        # the scroll position before the last simulation step, used to interpolate between steps
+        self._previous_scroll = 0.0
         for i in range(length):
             self._keys.append(PianoKey(i))
+        self._key_index = KeyIndex(length)
+        # the note bars of every instrument are drawn by the piano roll
+        self._roll = PianoRoll(self._key_index, self.width)
         self._instrument_audio = InstrumentAudio(SquareSynth, (0.1, 0.1, 0.5, 0.3))
 
         # add the synth manager to the audio manager
@@ -40,66 +63,154 @@ class Piano:
         ) as f:
             r = reader(f)
             self._qwerty_to_midi = {rows[0]: int(rows[1]) for rows in r}
-        # poll for midi events on a separate thread and place them in a queue to process them on the main thread
-        # apparently queues are thread safe src=https://www.geeksforgeeks.org/python-communicating-between-threads-set-1/
-        self._midi_event_queue = Queue()
-        Thread(
-            target=MidiDeviceProcessor,
-            args=(self._midi_event_queue,),
-            name="MidiProcessorThread",
-            daemon=True,
-        ).start()
+        # midi is polled on a separate thread that publishes it on the event bus, and processed on the main thread
+        self._midi_events = store.event_bus.subscribe("input", EventKind.MIDI)
+        # the note bars follow what every instrument plays
+        self._note_events = store.event_bus.subscribe(
+            "renderer", EventKind.NOTE_ON, EventKind.NOTE_OFF, EventKind.ALL_NOTES_OFF
+        )
+        # midi messages are dispatched by their status byte without the channel, so every channel is handled
+        self._midi_dispatch = {
+            0x80: self._midi_note_off,
+            0x90: self._midi_note_on,
+            0xB0: self._midi_control_change,
+        }
+        # notes that have been released while the sustain pedal is down keep sounding until the pedal is lifted
+        self._sustain = False
+        self._sustained_notes = set()
+        # a replay feeds the midi messages in itself, so live devices would make it differ from the recording
+        self._midi_input_manager = None
+        if midi_input:
+            self._midi_input_manager = MidiInputManager()
+            Thread(
+                target=self._midi_input_manager.run,
+                name="MidiInputThread",
+                daemon=True,
+            ).start()
 
     def __str__(self):
         return len(self._keys) + " Key Piano"
 
-    def render(self, screen):
-        # process midi events on the main thread
-        self.process_midi_events()
-        # update horizontal position before rendering
+    def step(self, screen):
+        """Advance the piano's motion by one simulation step."""
+        self._previous_scroll = self._horizontal_scroll
+        # ease the piano back into view if it has been scrolled past either end
         if self._horizontal_scroll > 0:
-            self.scroll_x(-self._horizontal_scroll / 20)
+            self._horizontal_scroll -= self._horizontal_scroll / 20
         elif screen.get_width() - self.width - self._horizontal_scroll > 0:
-            self.scroll_x(
-                (screen.get_width() - self.width - self._horizontal_scroll) / 20
-            )
+            self._horizontal_scroll += (
+                screen.get_width() - self.width - self._horizontal_scroll
+            ) / 20
+        self._roll.step(
+            self._horizontal_scroll,
+            self._key_index.visible(
+                -self._horizontal_scroll, screen.get_width() - self._horizontal_scroll
+            ),
+        )
 
-        for note_bar in self._note_bars:
-            note_bar.render(screen)
-        # not optimized but keeps the code simple so its fine
-        for key in self._keys:
-            if key.is_white:
-                key.render(screen)
-        for key in self._keys:
-            if key.is_black:
-                key.render(screen)
+    def render(self, screen, alpha: float = 1.0):
+        """Draw the piano `alpha` of the way between the previous and current simulation steps."""
+        scroll = (
+            self._previous_scroll
+            + (self._horizontal_scroll - self._previous_scroll) * alpha
+        )
+        # only visit the keys and note bars that are inside the viewport
+        visible = self._key_index.visible(-scroll, screen.get_width() - scroll)
+        self.process_note_events()
+        self._roll.paint()
+        self._roll.render(screen, scroll)
+        store.profiler.mark("note_bars")
+        for note in visible:
+            # keys outside the viewport aren't moved while scrolling, so catch them up before rendering
+            self._keys[note].move_to(self._key_index.x(note) + scroll)
+        for note in visible:
+            if self._keys[note].is_white:
+                self._keys[note].render(screen)
+        for note in visible:
+            if self._keys[note].is_black:
+                self._keys[note].render(screen)
+        store.profiler.mark("keys")
 
     def process_midi_events(self):
-        while not self._midi_event_queue.empty():
-            event = self._midi_event_queue.get()
-            event = event[0][0]
-            # this weird nested array datatype isn't my fault, blame pygame >:(((
-            if event[0] == 144:
-                self.play_from_midi(event[1], event[2])
-            elif event[0] == 128:
-                self.release_from_midi(event[1])
-
-    def play_from_midi(self, note: int, velocity: int):
+        # every message that has arrived since the last frame is handled as one batch
+        batch = [event[1:] for event in self._midi_events.drain()]
+        if not batch:
+            return
+        if store.input_trace is not None:
+            store.input_trace.record_midi(batch)
+        self.process_midi_batch(batch)
+
+    def process_midi_batch(self, batch: list[tuple[int, int, int, float, int]]):
+        """Play a batch of `(status, data1, data2, timestamp, source)` midi messages. Every source plays the same piano."""
+        for status, data1, data2, timestamp, _ in batch:
+            self.process_midi_message(status, data1, data2, timestamp)
+
+    def process_note_events(self):
+        """Press and release the note bars of the notes that the instruments have played since the last frame."""
+        for kind, channel, note, velocity, _, _ in self._note_events.drain():
+            instrument = ROLL_INSTRUMENTS.get(channel)
+            if instrument is None:
+                continue
+            if kind == EventKind.NOTE_ON:
+                self.add_note_bar(note, velocity, instrument)
+            elif kind == EventKind.NOTE_OFF:
+                self.release_note_bar(note, instrument)
+            else:
+                self.release_all_note_bars(instrument)
+
+    def process_midi_message(
+        self, status: int, data1: int, data2: int, timestamp: float = None
+    ):
+        handler = self._midi_dispatch.get(status & 0xF0)
+        if handler is not None:
+            handler(data1, data2, timestamp)
+
+    def _midi_note_on(self, note: int, velocity: int, timestamp: float):
+        # a note on with a velocity of 0 is a note off
+        if velocity == 0:
+            self.release_from_midi(note, timestamp)
+        else:
+            self.play_from_midi(note, velocity, timestamp)
+
+    def _midi_note_off(self, note: int, velocity: int, timestamp: float):
+        self.release_from_midi(note, timestamp)
+
+    def _midi_control_change(self, controller: int, value: int, timestamp: float):
+        # controller 64 is the sustain pedal
+        if controller != 64:
+            return
+        self._sustain = value >= 64
+        if not self._sustain:
+            for note in self._sustained_notes:
+                self._end_note(note, timestamp)
+            self._sustained_notes.clear()
+
+    def play_from_midi(self, note: int, velocity: int, timestamp: float = None):
+        """Play a note. `timestamp` is when it was played in `store.now()` seconds, which lets the audio start it at the exact frame."""
         # play a note if the midi note number is mapped to a key
         if note >= len(self._keys):
             return
+        # a sustained note that is played again is restarted
+        if note in self._sustained_notes:
+            self._sustained_notes.remove(note)
+            self._end_note(note, timestamp)
         self._keys[note].press(velocity)
-        store.app.composing_context.add_note(note)
         note = Note(note, velocity)
-        self._instrument_audio.play(note)
+        self._instrument_audio.play(note, timestamp)
 
-    def release_from_midi(self, note: int):
+    def release_from_midi(self, note: int, timestamp: float = None):
         # release the note based on the midi note number
         if note >= len(self._keys):
             return
         self._keys[note].release()
-        store.app.composing_context.remove_note(note)
-        self._instrument_audio.release(note)
+        if self._sustain:
+            self._sustained_notes.add(note)
+        else:
+            self._end_note(note, timestamp)
+
+    def _end_note(self, note: int, timestamp: float = None):
+        # stop the sound of a note whose key has been released
+        self._instrument_audio.release(note, timestamp)
 
     def play_from_qwerty(self, key):
         # play a note if the key is mapped to a note
@@ -109,7 +220,6 @@ class Piano:
             return
         note: int = self._qwerty_to_midi[key]
         self._keys[note].press()
-        store.app.composing_context.add_note(note)
         note: Note = Note(note, 80)
         self._instrument_audio.play(note)
 
@@ -121,15 +231,13 @@ class Piano:
             return
         note: int = self._qwerty_to_midi[key]
         self._keys[note].release()
-        store.app.composing_context.remove_note(note)
         self._instrument_audio.release(note)
 
     def scroll_x(self, amount):
+        # keys and note bars are moved lazily when they are rendered, so scrolling doesn't depend on the size of the piano
         self._horizontal_scroll += amount
-        for key in self._keys:
-            key.scroll_x(amount)
-        for note_bar in self._note_bars:
-            note_bar.scroll_x(amount)
+        # scrolling is instant, so it isn't interpolated
+        self._previous_scroll += amount
 
     @property
     def width(self) -> float:
@@ -140,114 +248,308 @@ class Piano:
             ]
         )
 
+    @property
+    def note_bar_count(self) -> int:
+        """The number of note bars that are held or still have to be painted into the piano roll."""
+        return len(self._roll)
+
+    @property
+    def midi_input_manager(self) -> MidiInputManager | None:
+        """The manager of the midi devices, whose `source_names` name the source of every midi event. None when midi input is off."""
+        return self._midi_input_manager
+
     def add_note_bar(self, note: int, velocity: int, instrument: str):
-        offsets = [0, 0.625, 1, 1.625, 2, 3, 3.625, 4, 4.625, 5, 5.625, 6]
-        x = self._horizontal_scroll + offsets[note % 12] * 50 + floor(note / 12) * 350
-        self._note_bars.append(NoteBar(note, x, velocity, instrument))
+        if note >= len(self._keys):
+            return
+        self._roll.press(note, velocity, instrument)
 
     def release_note_bar(self, note: int, instrument: str):
         # release the note bar that is playing the note and instrument
-        for note_bar in self._note_bars:
-            if (
-                note_bar.note == note
-                and note_bar.instrument == instrument
-                and not note_bar.released
-            ):
-                note_bar.release()
-                break
+        self._roll.release(note, instrument)
 
     def release_all_note_bars(self, instrument: str):
         # release all the note bars that are playing the instrument
-        for note_bar in self._note_bars:
-            if note_bar.instrument == instrument:
-                note_bar.release()
+        self._roll.release_all(instrument)
+
+
+SCALES = {"major": [0, 2, 4, 5, 7, 9, 11], "minor": [0, 2, 3, 5, 7, 8, 10]}
+# krumhansl-kessler key profiles: how well each pitch class fits a key, starting from the tonic
+PROFILES = {
+    "major": [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+    "minor": [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17],
+}
+# every key as (tonic, mode), in the same order as the rows of the tables below
+KEYS = [(tonic, mode) for mode in SCALES for tonic in range(12)]
+
+
+def pitch_class_mask(pitch_classes: set[int]) -> list[float]:
+    return [1.0 if pitch in pitch_classes else 0.0 for pitch in range(12)]
+
+
+def _normalized_profile(tonic: int, mode: str) -> np.ndarray:
+    # centered and scaled to a length of 1, so that a dot product with a centered histogram is proportional to their correlation
+    profile = np.roll(PROFILES[mode], tonic)
+    profile = profile - profile.mean()
+    return profile / np.linalg.norm(profile)
+
+
+KEY_PROFILES = np.array([_normalized_profile(tonic, mode) for tonic, mode in KEYS])
+# for every key, one row per degree of the scale with a 1 for the root, third and fifth of its chord
+CHORD_TEMPLATES = np.array(
+    [
+        [
+            pitch_class_mask(
+                {(tonic + SCALES[mode][(degree + step) % 7]) % 12 for step in (0, 2, 4)}
+            )
+            for degree in range(7)
+        ]
+        for tonic, mode in KEYS
+    ]
+)
 
 
 class ComposingContext:
     """A composing_context contains information about the music being played and methods for generating music."""
 
-    def __init__(self):
-        self._notes = []
-        self._note_frequency = [0] * 12
+    # the time it takes for a note to count half as much towards the key
+    HISTOGRAM_HALF_LIFE = 4.0
+
+    def __init__(self, style: str = "basic"):
+        # how many times each note is being held, e.g. by the keyboard and a midi device at once
+        self._held_counts = [0] * 128
+        self._pitch_class_counts = [0] * 12
+        # the held notes and pitch classes as bits, so the lowest note and the chord can be found without a loop
+        self._held_notes = 0
+        self._pitch_class_mask = 0
+        self._held_chord = None
+        # how much each pitch class has been played recently. every note is added with a weight that grows over time instead of decaying the older notes,
+        # so the real histogram is this divided by 2 ** ((now - origin) / half life), which doesn't change the key or the relative chord likelihoods
+        self._pitch_histogram = np.zeros(12)
+        self._histogram_origin = store.now()
+        # bumped whenever the histogram changes, so that the analysis is only redone when it could be different
+        self._version = 0
+        self._analysis_version = -1
+        self._key_sig = (0, "major")
+        self._key_notes = []
+        self._chord_likelihood_table = []
+        self._style = style
         self._auto_instruments: list[AutoInstrument] = [
-            AutoDrums(),
-            AutoChords(),
-            AutoBass(),
+            AutoDrums(STYLES[style]["drums"]),
+            AutoChords(STYLES[style]["chords"]),
+            AutoBass(STYLES[style]["bass"]),
         ]
         self._bpm = 120
-        self._last_tick = time()
+        # when the next 16th note starts, the ticks are counted from here so that they don't drift
+        self._next_tick = store.now()
         self._ticks = 0
+        # the number of measures whose patterns have been scheduled
+        self._compiled_measures = 0
         self._current_chord = 0
+        # the notes of the chord the accompaniment is playing, relative to middle c
+        self._current_chord_notes = []
+        # callbacks waiting to be called on the main thread, as a heap of (time, order, callback, args)
+        self._scheduled = []
+        self._scheduled_count = 0
+        self._last_update = store.now()
+        # the accompaniment follows the notes that the piano plays
+        self._note_events = store.event_bus.subscribe(
+            "composer", EventKind.NOTE_ON, EventKind.NOTE_OFF
+        )
 
     def add_note(self, note: int):
-        # add this note to the list of the notes that are currently being played
-        self._notes.append(note)
-
-        # update the note frequency list
-        # new notes matter more
-        self._note_frequency[note % 12] += 1
-        # old notes matter less
-        for i in range(12):
-            self._note_frequency[i] *= 0.9
-        # print(self.chord_likelihood_table)
+        # add this note to the notes that are currently being held
+        self._held_counts[note] += 1
+        self._pitch_class_counts[note % 12] += 1
+        self._held_notes |= 1 << note
+        self._pitch_class_mask |= 1 << note % 12
+        self._recognize_chord()
+
+        # new notes matter more than old ones by however much time has passed
+        now = store.now()
+        half_lives = (now - self._histogram_origin) / self.HISTOGRAM_HALF_LIFE
+        if half_lives > 40:
+            # apply the decay so far before the weights get too large, which only happens every couple of minutes
+            # after a long silence the old histogram simply decays to zero instead of the weight overflowing
+            self._pitch_histogram *= 2.0**-half_lives
+            self._histogram_origin = now
+            half_lives = 0.0
+        weight = 2.0**half_lives
+        self._pitch_histogram[note % 12] += weight
+        self._version += 1
 
     def remove_note(self, note: int):
-        self._notes.remove(note)
+        # notes that aren't held are ignored, e.g. when a note off arrives without its note on
+        if self._held_counts[note] == 0:
+            return
+        self._held_counts[note] -= 1
+        if self._held_counts[note] == 0:
+            self._held_notes &= ~(1 << note)
+        self._pitch_class_counts[note % 12] -= 1
+        if self._pitch_class_counts[note % 12] == 0:
+            self._pitch_class_mask &= ~(1 << note % 12)
+        self._recognize_chord()
+
+    def _recognize_chord(self):
+        if self._held_notes == 0:
+            self._held_chord = None
+            return
+        # the lowest set bit is the bass note
+        bass = (self._held_notes & -self._held_notes).bit_length() - 1
+        self._held_chord = recognize_chord(self._pitch_class_mask, bass)
 
     @property
-    def chord_likelihood_table(self) -> list[int]:
-        """A table of the likelihood of a chord being played based on the notes that have been played recently."""
-        output = [0] * 7
-
-        def chord_likelihood(chord: list[int]) -> float:
-            # the likelihood of a chord is the sum of the likelihood of each note in the chord
-            return sum([self._note_frequency[note % 12] for note in chord])
-
-        for i in range(len(self.key_notes)):
-            # check the root, third, and fifth for each chord
-            output[i] = chord_likelihood(
-                [
-                    self.key_notes[i],
-                    self.key_notes[(i + 2) % 7],
-                    self.key_notes[(i + 4) % 7],
-                ]
+    def held_chord(self) -> Chord | None:
+        """The chord made by the notes that are being held, if they make one."""
+        return self._held_chord
+
+    def _analyze(self):
+        """Work out the key and the chord likelihoods from the pitch histogram, if it has changed since the last time."""
+        if self._analysis_version == self._version:
+            return
+        self._analysis_version = self._version
+        total = self._pitch_histogram.sum()
+        if total == 0:
+            key = 0
+            self._chord_likelihood_table = [0.0] * 7
+        else:
+            histogram = self._pitch_histogram / total
+            # correlate the histogram with the profile of every key at once and pick the best fit
+            key = int(np.argmax(KEY_PROFILES @ (histogram - histogram.mean())))
+            # the likelihood of a chord is how much its root, third and fifth have been played
+            self._chord_likelihood_table = (CHORD_TEMPLATES[key] @ histogram).tolist()
+        tonic, mode = KEYS[key]
+        if (tonic, mode) != self._key_sig or not self._key_notes:
+            self._key_sig = (tonic, mode)
+            store.event_bus.publish(
+                BusEvent(EventKind.KEY, tonic, list(SCALES).index(mode))
             )
-        return output
+        self._key_notes = [x + tonic for x in SCALES[mode]]
+
+    @property
+    def chord_likelihood_table(self) -> list[float]:
+        """A table of the likelihood of a chord being played based on the notes that have been played recently."""
+        self._analyze()
+        return self._chord_likelihood_table
 
     # returns the notes in the key signature
     @property
     def key_notes(self) -> list[int]:
-        return [x + self.key_sig[0] for x in [0, 2, 4, 5, 7, 9, 11]]
+        self._analyze()
+        return self._key_notes
 
     @property
     def key_sig(self) -> tuple[int, str]:
-        key_sig = (0, "major")
+        self._analyze()
+        return self._key_sig
+
+    def schedule(self, delay: float, callback, *args):
+        """Call `callback(*args)` on the main thread after `delay` seconds."""
+        self.schedule_at(store.now() + delay, callback, *args)
+
+    def schedule_at(self, time: float, callback, *args):
+        """Call `callback(*args)` on the main thread in the last frame before `time`. Callbacks that play notes should pass `time` on as the timestamp, so the audio starts them at that exact frame."""
+        heappush(self._scheduled, (time, self._scheduled_count, callback, args))
+        self._scheduled_count += 1
+
+    def _update_chord(self):
+        # follow the chord that is being held, or otherwise the chord that is most likely to be played
+        if self._held_chord is not None:
+            self._current_chord_notes = [
+                self._held_chord.root + interval
+                for interval in self._held_chord.intervals
+            ]
+            return
+        max_val = max(self.chord_likelihood_table)
+        # don't play anything before notes have been played
+        if max_val == 0:
+            return
+        self._current_chord = self.chord_likelihood_table.index(max_val)
+        self._current_chord_notes = [
+            self.key_notes[(self._current_chord + step) % 7] for step in (0, 2, 4)
+        ]
 
-        # loop through major keys and find the maximum weight for each key based on the notes played
-        max_weight = 0
-        for i in range(12):
-            weight = sum(
-                [self._note_frequency[(i + x) % 12] for x in [0, 2, 4, 5, 7, 9, 11]]
-            )
-            if weight > max_weight:
-                max_weight = weight
-                key_sig = (i, "major")
-        key_sig_text = f"We think you're playing in {['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G','G#', 'A', 'A#', 'B'][key_sig[0]]} {key_sig[1]}"
-        store.app.ui[0].text = key_sig_text
-        return key_sig
+    def _compile_measure(self, start: float, tick_length: float):
+        for instrument in self._auto_instruments:
+            with trace_span(f"compile {instrument.name}"):
+                for time, callback, args in instrument.compile_measure(
+                    self, start, tick_length
+                ):
+                    self.schedule_at(time, callback, *args)
+
+    def process_note_events(self):
+        for kind, channel, note, _, _, _ in self._note_events.drain():
+            # the piano plays on channel 0, the other channels are the accompaniment itself
+            if channel != 0:
+                continue
+            if kind == EventKind.NOTE_ON:
+                self.add_note(note)
+            else:
+                self.remove_note(note)
 
     def update(self):
-        if (
-            time() - self._last_tick > 60 / self._bpm / 4
-        ):  # 4 ticks per beat (16th notes)
-            self._last_tick = time()
-            for instrument in self._auto_instruments:
-                instrument.tick(self)
+        self.process_note_events()
+        now = store.now()
+        # everything that is due before the next frame plus the audio's latency is handed over now, otherwise notes that fall between two frames would start up to a frame late.
+        # the next frame is guessed to take as long as the last one, but not more than a stall would
+        horizon = now + min(now - self._last_update, 0.1) + SCHEDULING_LATENCY
+        self._last_update = now
+        if now - self._next_tick > 1:
+            # don't play catch up after the app has been stalled
+            self._next_tick = now
+        while True:
+            # ticks and callbacks are run in the order they are due, so every note sees the chord of its own beat
+            if self._scheduled and self._scheduled[0][0] < self._next_tick:
+                if self._scheduled[0][0] > horizon:
+                    break
+                _, _, callback, args = heappop(self._scheduled)
+                callback(*args)
+                continue
+            if self._next_tick > horizon:
+                break
+            tick_length = 60 / self._bpm / 4  # 4 ticks per beat (16th notes)
+            if self.tick_in_measure == 0:
+                # the patterns are scheduled a measure ahead, so that nothing has to be worked out when they play
+                while self._compiled_measures <= self.measure + 1:
+                    measures_ahead = self._compiled_measures - self.measure
+                    self._compile_measure(
+                        self._next_tick + measures_ahead * 16 * tick_length,
+                        tick_length,
+                    )
+                    self._compiled_measures += 1
+            if self.tick_in_measure % 4 == 0:
+                self._update_chord()
             self._ticks += 1
+            self._next_tick += tick_length
+
+    def release_all(self, timestamp: float = None):
+        """Stop the accompaniment from playing anything that it has started."""
+        for instrument in self._auto_instruments:
+            instrument.release_all(timestamp)
+
+    @property
+    def style(self) -> str:
+        return self._style
+
+    @style.setter
+    def style(self, value: str):
+        """Change the style of the accompaniment from the next measure that is scheduled."""
+        self._style = value
+        for instrument in self._auto_instruments:
+            instrument.pattern = STYLES[value][instrument.name]
+
+    def next_style(self):
+        styles = list(STYLES)
+        index = (styles.index(self._style) + 1) % len(styles)
+        self.style = styles[index]
+        store.event_bus.publish(BusEvent(EventKind.STYLE, index))
 
     def change_bpm(self, value: int):
         self._bpm += value
-        store.app.ui[3].text = f"BPM: {self._bpm}"
+        store.event_bus.publish(BusEvent(EventKind.BPM, self._bpm))
+
+    @property
+    def bpm(self) -> int:
+        return self._bpm
 
     # a bunch of utility functions for making new auto instrument logic
     @property
@@ -278,148 +580,169 @@ class ComposingContext:
     def current_chord(self, value: int):
         self._current_chord = value
 
+    @property
+    def current_chord_notes(self) -> list[int]:
+        return self._current_chord_notes
 
-class AutoInstrument(ABC):
-    _instrument_audio: InstrumentAudio
+    @current_chord_notes.setter
+    def current_chord_notes(self, value: list[int]):
+        self._current_chord_notes = value
 
-    @abstractmethod
-    def tick(self, composing_context: ComposingContext):
-        """This function is called every 16th note. It should play notes automatically in the instrument based on the composing_context."""
-        raise NotImplementedError
 
+class AutoInstrument(ABC):
+    """Plays a pattern from `patterns.STYLES` along with the chord that is being played. Patterns are compiled into timed events a measure at a time."""
 
-class AutoDrums(AutoInstrument):
-    def __init__(self):
-        self._instrument_audio = InstrumentAudio(NoiseSynth, (0.01, 0.0, 1.0, 0.1))
+    name: str
+
+    def __init__(self, pattern: list, synth_voice, envelope_values, channel: int):
+        self.pattern = pattern
+        self._instrument_audio = InstrumentAudio(
+            synth_voice, envelope_values, channel=channel
+        )
         store.audio_manager.add_instrument_audio(self._instrument_audio)
+        # the notes being played, by the voice that played them
+        self._sounding = {}
+        self._voices = 0
 
-    def tick(self, composing_context: ComposingContext):
-        # play a snare every beat
-        if composing_context.ticks % 4 == 0:
-            self._instrument_audio.play(Note(12, 40))
-            store.app.piano.add_note_bar(12, 40, "drums")
-            # make a timer to release the note
-            Timer(0.02, self._instrument_audio.release, args=(12,)).start()
-            Timer(0.02, store.app.piano.release_note_bar, args=(12, "drums")).start()
-        # play a hat every 8th note and also sometimes on 16th notes randomly
-        elif (
-            composing_context.ticks % 2 == 0
-            or random() < 0.5
-            and composing_context.ticks % 4 != 0
-        ):
-            self._instrument_audio.play(Note(13, 20))
-            store.app.piano.add_note_bar(13, 20, "drums")
-            Timer(0.05, self._instrument_audio.release, args=(13,)).start()
-            Timer(0.05, store.app.piano.release_note_bar, args=(13, "drums")).start()
+    @property
+    def pattern(self) -> list:
+        return self._pattern
 
+    @pattern.setter
+    def pattern(self, value: list):
+        self._pattern = sorted(value)
 
-class AutoChords(AutoInstrument):
-    def __init__(self):
-        self._instrument_audio = InstrumentAudio(SineSynth, (0.1, 0.2, 0.9, 0.4))
-        store.audio_manager.add_instrument_audio(self._instrument_audio)
+    @abstractmethod
+    def pitch(self, tone: int, composing_context: ComposingContext) -> int | None:
+        """The midi note of a tone of the pattern, or None if it shouldn't be played."""
+        raise NotImplementedError
 
-    def tick(self, composing_context: ComposingContext):
-        # every beat, play the chord that is most likely to be played
-        if composing_context.ticks % 4 == 0:
-            max_val = max(composing_context.chord_likelihood_table)
-            # don't play anything before notes have been played
-            if max_val == 0:
-                return
-            # release all notes
-            self._instrument_audio.release_all()
-            store.app.piano.release_all_note_bars("chords")
-            most_likely_chord = composing_context.chord_likelihood_table.index(max_val)
-            # update the current chord
-            composing_context.current_chord = most_likely_chord
-            # play new notes
-            self._instrument_audio.play(
-                Note(60 + composing_context.key_notes[most_likely_chord], 80)
-            )
-            store.app.piano.add_note_bar(
-                60 + composing_context.key_notes[most_likely_chord], 80, "chords"
-            )
-            self._instrument_audio.play(
-                Note(
-                    60 + (composing_context.key_notes[(most_likely_chord + 2) % 7]), 60
+    def compile_measure(
+        self, composing_context: ComposingContext, start: float, tick_length: float
+    ) -> list:
+        """Work out the events of one measure of the pattern starting at `start`, as a sorted list of `(time, callback, args)`. The notes are picked when they are played, so that they follow the chord."""
+        events = []
+        for tick, tones, velocity, length, probability in self._pattern:
+            if probability < 1 and store.random.random() >= probability:
+                continue
+            tone = tones[0] if len(tones) == 1 else store.random.choice(tones)
+            press_time = start + tick * tick_length
+            release_time = press_time + length * tick_length
+            # releases sort before presses at the same time, so a note can be played again as it is released
+            events.append(
+                (
+                    press_time,
+                    1,
+                    self._press,
+                    (composing_context, self._voices, tone, velocity, press_time),
                 )
             )
-            store.app.piano.add_note_bar(
-                60 + (composing_context.key_notes[(most_likely_chord + 2) % 7]),
-                60,
-                "chords",
+            events.append(
+                (release_time, 0, self._release, (self._voices, release_time))
             )
-            self._instrument_audio.play(
-                Note(
-                    60 + (composing_context.key_notes[(most_likely_chord + 4) % 7]), 55
-                )
-            )
-            store.app.piano.add_note_bar(
-                60 + (composing_context.key_notes[(most_likely_chord + 4) % 7]),
-                55,
-                "chords",
+            self._voices += 1
+        events.sort(key=lambda event: event[:2])
+        return [(time, callback, args) for time, _, callback, args in events]
+
+    def _press(
+        self,
+        composing_context: ComposingContext,
+        voice: int,
+        tone: int,
+        velocity: int,
+        timestamp: float,
+    ):
+        note = self.pitch(tone, composing_context)
+        if note is None:
+            return
+        if (
+            store.autoplay_polyphony is not None
+            and len(self._sounding) >= store.autoplay_polyphony
+        ):
+            return
+        self._sounding[voice] = note
+        self._instrument_audio.play(Note(note, velocity), timestamp)
+        if store.tracer is not None:
+            # how long after its time the note was handed to the audio thread, negative when it was handed over ahead of time
+            store.tracer.instant(
+                f"{self.name} note",
+                note=note,
+                late_ms=(store.now() - timestamp) * 1000,
             )
 
+    def _release(self, voice: int, timestamp: float):
+        note = self._sounding.pop(voice, None)
+        if note is None:
+            return
+        self._instrument_audio.release(note, timestamp)
+
+    def release_all(self, timestamp: float = None):
+        """Release every note the pattern is playing, e.g. when the accompaniment stops."""
+        for voice in list(self._sounding):
+            self._release(voice, timestamp)
+
+
+class AutoDrums(AutoInstrument):
+    name = "drums"
+
+    def __init__(self, pattern: list):
+        super().__init__(pattern, NoiseSynth, (0.01, 0.0, 1.0, 0.1), 9)
+
+    def pitch(self, tone: int, composing_context: ComposingContext) -> int:
+        # drum tones are the notes of the drums
+        return tone
+
+
+class AutoChords(AutoInstrument):
+    name = "chords"
+
+    def __init__(self, pattern: list):
+        super().__init__(pattern, SineSynth, (0.1, 0.2, 0.9, 0.4), 1)
+
+    def pitch(self, tone: int, composing_context: ComposingContext) -> int | None:
+        chord_notes = composing_context.current_chord_notes
+        # triads don't have a seventh
+        if tone >= len(chord_notes):
+            return None
+        return 60 + chord_notes[tone]
+
 
 class AutoBass(AutoInstrument):
-    def __init__(self):
-        self._instrument_audio = InstrumentAudio(SineSynth, (0.1, 0.2, 0.9, 0.4))
-        store.audio_manager.add_instrument_audio(self._instrument_audio)
+    name = "bass"
+
+    def __init__(self, pattern: list):
+        super().__init__(pattern, SineSynth, (0.1, 0.2, 0.9, 0.4), 2)
 
-    def tick(self, composing_context: ComposingContext):
-        # only play bass notes on beats
-
-        if composing_context.ticks % 4 == 0:
-            # if the chord is being played, play some bass
-            max_val = max(composing_context.chord_likelihood_table)
-            if max_val == 0:
-                return
-            # match the root note
-            root_note = composing_context.current_chord
-            # on the first beat of every measure, play the root note of the chord
-            if composing_context.ticks % 16 == 0:
-
-                root_note = composing_context.key_notes[root_note]
-                # play the note two octaves lower
-                self._instrument_audio.play(Note(60 - 24 + root_note, 127))
-                store.app.piano.add_note_bar(60 - 24 + root_note, 127, "bass")
-                Timer(
-                    0.5, self._instrument_audio.release, args=(60 - 24 + root_note,)
-                ).start()
-                Timer(
-                    0.5,
-                    store.app.piano.release_note_bar,
-                    args=(60 - 24 + root_note, "bass"),
-                ).start()
-
-            # on other beats, 50% chance to play any note from the chord
-            elif random() > 0.5:
-                if random() > 1 / 3:
-                    note = composing_context.key_notes[root_note]
-                elif random() > 1 / 2:
-                    note = composing_context.key_notes[(root_note + 2) % 7]
-                else:
-                    note = composing_context.key_notes[(root_note + 4) % 7]
-
-                # play the note two octaves lower
-                self._instrument_audio.play(Note(60 - 24 + note, 127))
-                store.app.piano.add_note_bar(60 - 24 + note, 127, "bass")
-                Timer(
-                    0.5, self._instrument_audio.release, args=(60 - 24 + note,)
-                ).start()
-                Timer(
-                    0.5, store.app.piano.release_note_bar, args=(60 - 24 + note, "bass")
-                ).start()
+    def pitch(self, tone: int, composing_context: ComposingContext) -> int | None:
+        chord_notes = composing_context.current_chord_notes
+        if tone >= len(chord_notes):
+            return None
+        # two octaves lower than the chords
+        return 60 - 24 + chord_notes[tone]
 
 
 class App:
-    def __init__(self):
-        # create a new AudioManager to deal with sound processing if it doesn't already exist and a new thread to calculate audio samples
+    def __init__(self, midi_input: bool = True):
+        """`midi_input` can be turned off to ignore midi devices, e.g. when the input comes from a replay."""
+        # create a new AudioManager to deal with sound processing if it doesn't already exist, its output is started by `start_audio`
         if store.audio_manager is None:
             store.audio_manager = AudioManager()
-        self._piano = Piano(88)
+        if store.profiler is None:
+            store.profiler = FrameProfiler()
+        self._piano = Piano(88, midi_input)
         self._composing_context = ComposingContext()
+        self._ui_events = store.event_bus.subscribe(
+            "ui", EventKind.KEY, EventKind.BPM, EventKind.STYLE
+        )
         store.app = self
-        store.audio_manager.start()
+        # the visualiser reads the latest output of the audio thread
+        self._scope = AudioScope(sample_rate=store.audio_manager.sample_rate)
+        store.audio_manager.add_tap(self._scope)
+        # plays a midi file through the piano when one has been opened with `play_file`
+        self._player = None
+        # time that hasn't been simulated yet, always less than one step after an update
+        self._accumulator = 0.0
+        self._last_update = store.now()
         self._ui = [
             UiText(
                 0, 0, 0, 0, "Press any key to start composing"
@@ -439,25 +762,110 @@ class App:
             UiButton(
                 0, 75, 0, 0, "BPM -", lambda: self._composing_context.change_bpm(-1)
             ),  # Decrease the BPM
+            UiButton(
+                0,
+                100,
+                0,
+                0,
+                f"Style: {self._composing_context.style}",
+                self._composing_context.next_style,
+            ),  # Change the style of the accompaniment
+            UiProfilerOverlay(-260, 0, 1, 0, store.profiler),  # Frame timings (F3)
+            UiVisualiser(
+                -360, -359, 1, 1, self._scope
+            ),  # Spectrum and waveform of the audio output, above the right of the piano (F7)
         ]
 
+    def process_ui_events(self):
+        """Show the changes to the state of the accompaniment that have been published since the last frame."""
+        for kind, data1, data2, _, _, _ in self._ui_events.drain():
+            if kind == EventKind.KEY:
+                self._ui[0].text = (
+                    f"We think you're playing in {NOTE_NAMES[data1]} {list(SCALES)[data2]}"
+                )
+            elif kind == EventKind.BPM:
+                self._ui[3].text = f"BPM: {data1}"
+            else:
+                self._ui[6].text = f"Style: {list(STYLES)[data1]}"
+
+    def start_audio(self):
+        """Open the audio device and start calculating samples on its thread. This can be slow, so it is kept out of `__init__` to be run in the background."""
+        store.audio_manager.start()
+
+    def update(self):
+        """Process input and advance the simulation by however many fixed steps have passed since the last update."""
+        now = store.now()
+        # don't try to catch up on more than a quarter of a second, e.g. after the window has been dragged
+        self._accumulator += min(now - self._last_update, 0.25)
+        self._last_update = now
+        # process midi events on the main thread
+        self._piano.process_midi_events()
+        self.process_ui_events()
+        if self._player is not None:
+            self._player.update()
+            if self._player.finished:
+                self._player = None
+        store.profiler.mark("midi")
+        while self._accumulator >= STEP:
+            self._piano.step(store.screen)
+            for particle in store.particles:
+                particle.step()
+            self._accumulator -= STEP
+        store.particles = [particle for particle in store.particles if particle.alive]
+        store.profiler.mark("simulation")
+        self._composing_context.update()
+        store.profiler.mark("composer")
+
     def render(self, screen):
+        # how far between the last two simulation steps the frame is drawn
+        alpha = self._accumulator / STEP
         screen.fill(store.COLOR_PALETTE["background"])
+        store.profiler.mark("clear")
         # render the piano and particles
-        self._piano.render(screen)
+        self._piano.render(screen, alpha)
         for particle in store.particles:
-            particle.render(screen)
+            particle.render(screen, alpha)
+        store.profiler.mark("particles")
         # render the ui
         for ui_element in self._ui:
             ui_element.render(screen)
-        # update the composing context (the only reason this is in the render function is because it needs to be called every frame)
-        self._composing_context.update()
+        store.profiler.mark("ui")
+
+    def play_file(self, file_path: str, speed: float = 1.0):
+        """Play a midi file through the piano."""
+        self._player = MidiFilePlayer(file_path, self._piano, speed)
+
+    def toggle_recording(self, file_path: str = None):
+        """Start recording everything that is played to a midi file, or stop the recording if there is one."""
+        if store.recorder is not None:
+            store.recorder.stop()
+            store.recorder = None
+            return
+        if file_path is None:
+            file_path = f"recording-{strftime('%Y%m%d-%H%M%S')}.mid"
+        store.recorder = PerformanceRecorder(file_path)
+        print(f"Recording to {file_path}")
+
+    def toggle_bounce(self, file_path: str = None):
+        """Start writing the audio output to a wav file, or stop it if it is being written."""
+        if store.bounce is not None:
+            store.audio_manager.remove_tap(store.bounce)
+            store.bounce.stop()
+            store.bounce = None
+            return
+        if file_path is None:
+            file_path = f"bounce-{strftime('%Y%m%d-%H%M%S')}.wav"
+        store.bounce = AudioBounce(file_path, store.audio_manager.sample_rate)
+        store.audio_manager.add_tap(store.bounce)
+        print(f"Bouncing audio to {file_path}")
 
     def play(self, note):
         self._composing_context.play(note)
         self._piano.play(note)
 
     def process_event(self, event):
+        if store.input_trace is not None:
+            store.input_trace.record_event(event)
         for ui_element in self._ui:
             ui_element.process_event(event)
         if event.type == KEYDOWN:
@@ -466,6 +874,10 @@ class App:
                 self._piano.scroll_x(50)
             elif event.key == K_RIGHT:
                 self._piano.scroll_x(-50)
+            elif event.key == K_F5:
+                self.toggle_recording()
+            elif event.key == K_F6:
+                self.toggle_bounce()
         elif event.type == KEYUP:
             self._piano.release_from_qwerty(event.unicode.lower())
         elif event.type == MOUSEWHEEL:
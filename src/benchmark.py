@@ -0,0 +1,226 @@
+"""Headless rendering benchmark.
+
+Runs the app under SDL's dummy video driver with the audio engine stubbed out and drives it with scripted workloads.
+The app runs on a simulated clock that advances one 60 fps frame at a time, and the random number generators are seeded, so every run does the same work and only the time it takes differs.
+Frame times and object counts are written as json, and can be compared against a stored baseline:
+
+    python src/benchmark.py --output bench.json
+    python src/benchmark.py --baseline bench.json --tolerance 0.2
+"""
+
+from argparse import ArgumentParser
+from json import dump, load
+from os import environ
+from statistics import mean
+from sys import exit
+from time import perf_counter
+
+# the dummy drivers have to be selected before pygame initializes its display
+environ.setdefault("SDL_VIDEODRIVER", "dummy")
+environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+from pygame import display, init
+
+import store
+from input_trace import SimulatedClock
+from profiler import FrameProfiler
+from rendering import Particle
+
+
+class NullAudioManager:
+    """Stands in for `AudioManager` so that no audio device is opened and no samples are calculated."""
+
+    def __init__(self):
+        self._instrument_audios = []
+
+    def add_instrument_audio(self, instrument_audio):
+        self._instrument_audios.append(instrument_audio)
+
+    def add_tap(self, tap):
+        pass
+
+    @property
+    def sample_rate(self) -> int:
+        return 44100
+
+    def start(self):
+        pass
+
+
+def sustained_chords(app, frame: int):
+    # four note chords held for most of half a second, moving around the keyboard
+    root = 24 + frame // 30 * 5 % 48
+    if frame % 30 == 0:
+        for interval in (0, 4, 7, 11):
+            app.piano.play_from_midi(root + interval, 100)
+    elif frame % 30 == 25:
+        for interval in (0, 4, 7, 11):
+            app.piano.release_from_midi(root + interval)
+
+
+def glissando(app, frame: int):
+    # one new note every frame, sweeping up and down the whole keyboard
+    note = abs(frame % 174 - 87)
+    app.piano.play_from_midi(note, 90)
+    if frame > 0:
+        app.piano.release_from_midi(abs((frame - 1) % 174 - 87))
+
+
+def fast_autoplay(app, frame: int):
+    if frame == 0:
+        app.composing_context.change_bpm(600 - app.composing_context.bpm)
+        # give the auto instruments something to accompany
+        for note in (60, 64, 67):
+            app.piano.play_from_midi(note, 80)
+    elif frame % 60 == 0:
+        note = 60 + frame // 60 % 12
+        app.piano.play_from_midi(note, 80)
+        app.piano.release_from_midi(note)
+
+
+def particle_storm(app, frame: int, count: int = 3000):
+    # keep a large number of particles alive
+    while len(store.particles) < count:
+        store.particles.append(
+            Particle(
+                frame % 800,
+                -300,
+                ((frame % 9) - 4, -(frame % 7) - 2),
+                1,
+                3,
+            )
+        )
+
+
+# the simulated time of each frame
+FRAME_LENGTH = 1 / 60
+
+WORKLOADS = {
+    "sustained_chords": sustained_chords,
+    "glissando": glissando,
+    "fast_autoplay": fast_autoplay,
+    "particle_storm": particle_storm,
+}
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[round((len(samples) - 1) * fraction)]
+
+
+def run_workload(name: str, frames: int, size: tuple[int, int]) -> dict:
+    # the app imports the audio engine, so it is only imported once the stub is in place
+    from app import App
+
+    clock = SimulatedClock()
+    store.now = clock.now
+    store.random.seed(0)
+    store.noise_random.seed(0)
+    store.particles.clear()
+    store.audio_manager = NullAudioManager()
+    store.profiler = FrameProfiler(window=frames)
+    store.screen = display.set_mode(size)
+    app = App(midi_input=False)
+    workload = WORKLOADS[name]
+
+    frame_times = []
+    object_counts = []
+    for frame in range(frames):
+        store.profiler.begin_frame()
+        start = perf_counter()
+        workload(app, frame)
+        store.profiler.mark("workload")
+        app.update()
+        app.render(store.screen)
+        display.flip()
+        store.profiler.mark("flip")
+        frame_times.append(perf_counter() - start)
+        store.profiler.end_frame()
+        object_counts.append(
+            {
+                "frame": frame,
+                "note_bars": app.piano.note_bar_count,
+                "particles": len(store.particles),
+            }
+        )
+        clock.advance(FRAME_LENGTH)
+
+    frame_ms = [frame_time * 1000 for frame_time in frame_times]
+    return {
+        "frames": frames,
+        "frame_ms": {
+            "mean": mean(frame_ms),
+            "p50": percentile(frame_ms, 0.5),
+            "p95": percentile(frame_ms, 0.95),
+            "p99": percentile(frame_ms, 0.99),
+            "max": max(frame_ms),
+        },
+        "stage_p95_ms": {
+            stage: store.profiler.percentiles(stage)[1] * 1000
+            for stage in store.profiler.stages
+        },
+        "max_note_bars": max(counts["note_bars"] for counts in object_counts),
+        "max_particles": max(counts["particles"] for counts in object_counts),
+        # sample the object counts so that the report stays small
+        "object_counts": object_counts[:: max(1, frames // 50)],
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return a description of every workload whose p95 frame time regressed by more than `tolerance`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["frame_ms"]["p95"]
+        after = result["frame_ms"]["p95"]
+        if after > before * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before:.2f} ms -> {after:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument(
+        "--workload", action="append", choices=list(WORKLOADS), dest="workloads"
+    )
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare the results to this json file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed p95 frame time regression against the baseline (0.2 = 20%%)",
+    )
+    args = parser.parse_args()
+
+    init()
+    results = {}
+    for name in args.workloads or list(WORKLOADS):
+        results[name] = run_workload(name, args.frames, (args.width, args.height))
+        frame_ms = results[name]["frame_ms"]
+        print(
+            f"{name}: p50 {frame_ms['p50']:.2f} ms, p95 {frame_ms['p95']:.2f} ms, "
+            f"p99 {frame_ms['p99']:.2f} ms, max {frame_ms['max']:.2f} ms, "
+            f"{results[name]['max_note_bars']} note bars, "
+            f"{results[name]['max_particles']} particles"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression in {regression}")
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
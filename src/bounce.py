@@ -0,0 +1,95 @@
+from threading import Event, Thread
+from wave import open as open_wave
+
+
+class AudioBounce:
+    """Writes the output of the `AudioManager` to a wav file, exactly as it was played.
+
+    The audio thread only copies each block into a ring buffer that is allocated up front. A background thread writes the ring to the file in large chunks, so the audio thread never waits on the disk.
+    If the disk falls so far behind that a block doesn't fit in the ring, the block is dropped and counted, and the writer reports it.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        sample_rate: int,
+        seconds: float = 10.0,
+        flush_interval: float = 0.25,
+    ):
+        self._file_path = file_path
+        self._flush_interval = flush_interval
+        self._sample_rate = sample_rate
+        # 16 bit mono, the same as the audio device is given
+        self._ring = bytearray(int(sample_rate * seconds) * 2)
+        # the number of bytes ever written into and read out of the ring. each is only changed by one thread, and the audio thread only moves `_written` after the block has been copied
+        self._written = 0
+        self._read = 0
+        self._dropped = 0
+        self._reported_dropped = 0
+        self._frames = 0
+        self._wave_file = open_wave(file_path, "wb")
+        self._wave_file.setnchannels(1)
+        self._wave_file.setsampwidth(2)
+        self._wave_file.setframerate(sample_rate)
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="BounceThread", daemon=True)
+        self._thread.start()
+
+    def __call__(self, block: bytes):
+        """Copy a block of output into the ring. Called on the audio thread by the `AudioManager` tap."""
+        size = len(block)
+        capacity = len(self._ring)
+        if size > capacity - (self._written - self._read):
+            self._dropped += 1
+            return
+        start = self._written % capacity
+        first = min(size, capacity - start)
+        # slices of a memoryview don't copy the block, and assigning them to slices of the same length copies into the ring in place
+        block = memoryview(block)
+        self._ring[start : start + first] = block[:first]
+        if first < size:
+            self._ring[: size - first] = block[first:]
+        self._written += size
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            self._flush()
+        self._flush()
+        self._wave_file.close()
+
+    def _flush(self):
+        written = self._written
+        size = written - self._read
+        if size:
+            capacity = len(self._ring)
+            start = self._read % capacity
+            first = min(size, capacity - start)
+            # the part of the ring that is being written out can't be overwritten until `_read` has moved past it
+            chunk = self._ring[start : start + first]
+            if first < size:
+                chunk += self._ring[: size - first]
+            self._wave_file.writeframesraw(chunk)
+            self._frames += size // 2
+            self._read = written
+        if self._dropped != self._reported_dropped:
+            print(
+                f"Bounce to {self._file_path} dropped {self._dropped - self._reported_dropped} blocks because the disk fell behind"
+            )
+            self._reported_dropped = self._dropped
+
+    def stop(self):
+        """Write what is left in the ring and close the file. The bounce should be removed from the audio manager first."""
+        self._stopped.set()
+        self._thread.join()
+        print(
+            f"Bounced {self._frames / self._sample_rate:.1f} s of audio to {self._file_path}"
+            + (f", {self._dropped} blocks were dropped" if self._dropped else "")
+        )
+
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
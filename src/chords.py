@@ -0,0 +1,106 @@
+"""Recognizes chords from the pitch classes being held.
+
+Every set of pitch classes fits in 12 bits, so the best chord for each of the 4096 sets is worked out once on import and recognizing a chord is a single lookup.
+"""
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+# the intervals of each chord above its root, listed as root, third, fifth and seventh so that the index of the bass note is the inversion
+CHORD_QUALITIES = {
+    "": (0, 4, 7),
+    "m": (0, 3, 7),
+    "dim": (0, 3, 6),
+    "aug": (0, 4, 8),
+    "sus2": (0, 2, 7),
+    "sus4": (0, 5, 7),
+    "7": (0, 4, 7, 10),
+    "maj7": (0, 4, 7, 11),
+    "m7": (0, 3, 7, 10),
+    "m7b5": (0, 3, 6, 10),
+    "dim7": (0, 3, 6, 9),
+}
+
+
+def pitch_class_bits(pitch_classes) -> int:
+    """The pitch classes as 12 bits, the lowest for c."""
+    mask = 0
+    for pitch_class in pitch_classes:
+        mask |= 1 << (pitch_class % 12)
+    return mask
+
+
+def _build_chord_table() -> list[tuple[tuple[int, str], ...]]:
+    """For every 12-bit mask, the chords that explain it best as `(root, quality)` tuples. A chord explains a mask if all of its notes are held and at most one other note is, and chords with more notes are better."""
+    table = [()] * 4096
+    sizes = [0] * 4096
+    for quality, intervals in CHORD_QUALITIES.items():
+        for root in range(12):
+            chord_mask = pitch_class_bits(root + interval for interval in intervals)
+            # the chord itself, and the chord with one extra note like an added ninth
+            for mask in {chord_mask} | {chord_mask | 1 << extra for extra in range(12)}:
+                if len(intervals) > sizes[mask]:
+                    sizes[mask] = len(intervals)
+                    table[mask] = ((root, quality),)
+                elif len(intervals) == sizes[mask]:
+                    table[mask] += ((root, quality),)
+    return table
+
+
+CHORD_TABLE = _build_chord_table()
+
+
+class Chord:
+    """A chord that has been recognized from the notes being held."""
+
+    def __init__(self, root: int, quality: str, bass: int):
+        self._root = root
+        self._quality = quality
+        intervals = CHORD_QUALITIES[quality]
+        # notes that aren't in the chord, like an added ninth, leave it in root position
+        bass_interval = (bass - root) % 12
+        self._inversion = (
+            intervals.index(bass_interval) if bass_interval in intervals else 0
+        )
+
+    @property
+    def root(self) -> int:
+        return self._root
+
+    @property
+    def quality(self) -> str:
+        return self._quality
+
+    @property
+    def inversion(self) -> int:
+        return self._inversion
+
+    @property
+    def intervals(self) -> tuple[int, ...]:
+        return CHORD_QUALITIES[self._quality]
+
+    @property
+    def pitch_classes(self) -> list[int]:
+        return [(self._root + interval) % 12 for interval in self.intervals]
+
+    @property
+    def name(self) -> str:
+        name = NOTE_NAMES[self._root] + self._quality
+        if self._inversion:
+            name += "/" + NOTE_NAMES[self.pitch_classes[self._inversion]]
+        return name
+
+    def __repr__(self) -> str:
+        return f"Chord({self.name})"
+
+
+def recognize_chord(mask: int, bass: int) -> Chord | None:
+    """The chord made by the pitch classes in `mask`, or None if they don't make one. `bass` is the lowest note being held, which picks between chords with the same notes (e.g. Csus2 and Gsus4) and gives the inversion."""
+    candidates = CHORD_TABLE[mask]
+    if not candidates:
+        return None
+    root, quality = candidates[0]
+    for candidate_root, candidate_quality in candidates:
+        if candidate_root == bass % 12:
+            root, quality = candidate_root, candidate_quality
+            break
+    return Chord(root, quality, bass % 12)
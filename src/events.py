@@ -0,0 +1,157 @@
+"""The event bus that carries notes and state changes between threads.
+
+Producers (the midi thread, the keyboard, the accompaniment) publish small fixed-size events, and every consumer (the audio engine, the piano roll, the composer, the ui) gets its own queue of the kinds it subscribed to.
+Each consumer drains its whole queue at once on its own thread, once per audio block or frame, so nothing outside the queues is shared between threads and no locks are taken per event.
+"""
+
+from collections import deque
+from enum import IntEnum
+from time import perf_counter
+from typing import NamedTuple
+
+
+class EventKind(IntEnum):
+    # a message from a midi device: status, data1, data2, and the device as the source
+    MIDI = 0
+    # a note that an instrument starts or stops playing: channel, note, velocity
+    NOTE_ON = 1
+    NOTE_OFF = 2
+    # every note of an instrument stops: channel
+    ALL_NOTES_OFF = 3
+    # the detected key changed: tonic, mode (0 for major, 1 for minor)
+    KEY = 4
+    # the tempo changed: bpm
+    BPM = 5
+    # the accompaniment style changed: index into patterns.STYLES
+    STYLE = 6
+
+
+class BusEvent(NamedTuple):
+    kind: EventKind
+    data1: int = 0
+    data2: int = 0
+    data3: int = 0
+    # when the event should take effect in `store.now()` seconds, or None for as soon as possible
+    timestamp: float = None
+    # which midi device a midi message came from, as numbered by `MidiInputManager.source_names`. 0 is anything that isn't a midi device, e.g. OSC
+    source: int = 0
+
+
+class EventConsumer:
+    """The queue of one consumer. Only the thread that owns the consumer should drain it.
+
+    The queue holds at most `capacity` events, so a consumer that stops draining, e.g. an audio engine without a device, can't grow it forever. When it is full the oldest event is dropped and counted.
+    """
+
+    def __init__(self, name: str, kinds: frozenset, capacity: int = 4096):
+        self._name = name
+        self._kinds = kinds
+        # appending and popping from opposite ends of a deque is thread safe
+        self._queue = deque(maxlen=capacity)
+        self._drained = 0
+        self._dropped = 0
+        self._largest_batch = 0
+
+    def drain(self) -> list[BusEvent]:
+        """Take every event that has been published since the last drain, in the order they were published."""
+        queue = self._queue
+        # events published while draining are left for the next drain, so a busy producer can't hold the consumer up
+        batch = [queue.popleft() for _ in range(len(queue))]
+        self._drained += len(batch)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        return batch
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def kinds(self) -> frozenset:
+        return self._kinds
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    @property
+    def largest_batch(self) -> int:
+        return self._largest_batch
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+
+class EventBus:
+    """Routes published events to the queues of the consumers that subscribed to their kind, and meters how many pass through."""
+
+    def __init__(self):
+        self._consumers: dict[str, EventConsumer] = {}
+        # the consumers of each kind, replaced as a whole when they change so producers never see a half updated list
+        self._routes: list[tuple[EventConsumer, ...]] = [() for _ in EventKind]
+        self._published = [0] * len(EventKind)
+        self._last_meter = (perf_counter(), [0] * len(EventKind), {}, {})
+
+    def subscribe(self, name: str, *kinds: EventKind) -> EventConsumer:
+        """Make a consumer of the given kinds of events. A consumer with the same name replaces the old one, e.g. when the app is created again."""
+        consumer = EventConsumer(name, frozenset(kinds))
+        self._consumers[name] = consumer
+        self._update_routes()
+        return consumer
+
+    def unsubscribe(self, consumer: EventConsumer):
+        if self._consumers.get(consumer.name) is consumer:
+            del self._consumers[consumer.name]
+            self._update_routes()
+
+    def _update_routes(self):
+        self._routes = [
+            tuple(
+                consumer
+                for consumer in self._consumers.values()
+                if kind in consumer.kinds
+            )
+            for kind in EventKind
+        ]
+
+    def publish(self, event: BusEvent):
+        for consumer in self._routes[event.kind]:
+            queue = consumer._queue
+            if len(queue) == queue.maxlen:
+                consumer._dropped += 1
+            queue.append(event)
+        self._published[event.kind] += 1
+
+    def publish_batch(self, events: list[BusEvent]):
+        for event in events:
+            self.publish(event)
+
+    def throughput(self) -> dict[str, float]:
+        """The events per second of each kind that was published, of each consumer that drained events and of each consumer that dropped events, since the last call."""
+        now = perf_counter()
+        last_time, last_published, last_drained, last_dropped = self._last_meter
+        elapsed = max(now - last_time, 1e-9)
+        rates = {
+            f"published {kind.name.lower()}": (count - last_published[kind]) / elapsed
+            for kind, count in zip(EventKind, self._published)
+            if count > last_published[kind]
+        }
+        drained = {}
+        dropped = {}
+        for name, consumer in self._consumers.items():
+            drained[name] = consumer._drained
+            dropped[name] = consumer._dropped
+            if consumer._drained > last_drained.get(name, 0):
+                rates[f"drained by {name}"] = (
+                    consumer._drained - last_drained.get(name, 0)
+                ) / elapsed
+            if consumer._dropped > last_dropped.get(name, 0):
+                rates[f"dropped by {name}"] = (
+                    consumer._dropped - last_dropped.get(name, 0)
+                ) / elapsed
+        self._last_meter = (now, list(self._published), drained, dropped)
+        return rates
+
+    @property
+    def consumers(self) -> list[EventConsumer]:
+        return list(self._consumers.values())
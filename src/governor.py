@@ -0,0 +1,112 @@
+"""Trades visual and audio detail for meeting deadlines when the computer can't keep up.
+
+The governor watches how long frames take and how much of each audio block's time the audio thread needs, and steps the quality settings in `store` down one stage at a time when either is in trouble, and back up once there is headroom again.
+The audio deadline comes first: the audio being in trouble steps down straight away and through every stage, while slow frames only step down slowly and only through the visual stages.
+"""
+
+from collections import deque
+
+import store
+
+# each stage is the settings on top of the ones before it, with a description for the log
+STAGES = [
+    ("full quality", {}),
+    ("fewer particles", {"particle_density": 0.5}),
+    (
+        "no particles, simple visualiser",
+        {"particle_density": 0.0, "detailed_visuals": False},
+    ),
+    ("lower frame cap", {"frame_cap": 30}),
+    (
+        "less autoplay polyphony, no effects",
+        {"autoplay_polyphony": 2, "audio_effects": False},
+    ),
+]
+# the last stage that slow frames alone can step down to, the ones after it take detail away from the audio
+LAST_VISUAL_STAGE = 3
+
+
+class LoadGovernor:
+    """Steps through `STAGES` based on the frame times from `store.profiler` and the audio load from `store.audio_manager`. `update` is called once per frame on the main thread."""
+
+    def __init__(
+        self,
+        audio_limit: float = 0.7,
+        window: int = 60,
+        cooldown: float = 0.5,
+        recovery: float = 3.0,
+    ):
+        # the most of an audio block's time that rendering it may take
+        self._audio_limit = audio_limit
+        self._busy_times = deque(maxlen=window)
+        # how long to wait after a change before stepping down again, and how long everything has to be healthy before stepping up
+        self._cooldown = cooldown
+        self._recovery = recovery
+        self._stage = 0
+        # the settings as they were before the governor changed them
+        self._defaults = {
+            name: getattr(store, name) for _, settings in STAGES for name in settings
+        }
+        self._last_change = store.now()
+        self._healthy_since = store.now()
+        self._underflows = store.audio_manager.underflows
+
+    def update(self):
+        now = store.now()
+        self._busy_times.append(store.profiler.busy_time)
+        audio_load = store.audio_manager.load
+        underflows = store.audio_manager.underflows
+        audio_missed = underflows > self._underflows
+        self._underflows = underflows
+
+        if audio_missed or audio_load > self._audio_limit:
+            self._healthy_since = now
+            if (
+                now - self._last_change > self._cooldown
+                and self._stage < len(STAGES) - 1
+            ):
+                reason = (
+                    "the audio missed a deadline"
+                    if audio_missed
+                    else f"audio blocks take {audio_load:.0%} of their time"
+                )
+                self._set_stage(self._stage + 1, reason)
+            return
+        # only frames that have been measured since the last change count
+        if len(self._busy_times) < self._busy_times.maxlen:
+            return
+        busy = sorted(self._busy_times)[len(self._busy_times) * 9 // 10]
+        # the longest a frame may take to do its work at the frame cap, not counting the time spent waiting for it
+        budget = 1 / (store.frame_cap or 60)
+        if busy > budget:
+            self._healthy_since = now
+            if self._stage < LAST_VISUAL_STAGE:
+                self._set_stage(
+                    self._stage + 1, f"frames take {busy * 1000:.1f} ms (p90)"
+                )
+        elif busy > budget / 2 or audio_load > self._audio_limit / 2:
+            # not in trouble, but not enough headroom to bring detail back either
+            self._healthy_since = now
+        elif self._stage > 0 and now - self._healthy_since > self._recovery:
+            self._set_stage(self._stage - 1, "there is headroom again")
+
+    def _set_stage(self, stage: int, reason: str):
+        self._stage = stage
+        settings = dict(self._defaults)
+        for _, stage_settings in STAGES[1 : stage + 1]:
+            settings.update(stage_settings)
+        for name, value in settings.items():
+            if name == "frame_cap" and self._defaults[name]:
+                # never raise a frame cap that was already lower
+                value = min(value, self._defaults[name])
+            setattr(store, name, value)
+        print(
+            f"Load governor: stage {stage} of {len(STAGES) - 1} ({STAGES[stage][0]}) because {reason}"
+        )
+        self._busy_times.clear()
+        self._last_change = store.now()
+        self._healthy_since = self._last_change
+
+    @property
+    def stage(self) -> int:
+        return self._stage
@@ -0,0 +1,211 @@
+"""Deterministic capture and replay of input for performance comparisons.
+
+A trace holds the seed of the random number generators and every pygame event and midi batch the app received, with the time it arrived.
+Replaying it feeds the same input through `App.process_event` and the midi path on a simulated clock, headless, so every replay of a trace does exactly the same audio and frame work:
+
+    python src/main.py --capture-trace session.trace
+    python src/input_trace.py session.trace --fast --output replay.json
+"""
+
+from argparse import ArgumentParser
+from gzip import open as open_gzip
+from hashlib import sha1
+from json import dump, dumps, loads
+from os import environ
+from random import getrandbits
+from time import perf_counter, sleep
+from wave import open as open_wave
+
+import store
+from profiler import FrameProfiler
+
+# the only event attributes that the app reads, everything else is left out of the trace
+EVENT_ATTRIBUTES = ("key", "unicode", "mod", "scancode", "pos", "button", "x", "y")
+
+
+class InputTrace:
+    """Records the input the app receives to a gzipped json lines file. Start it before the `App` is created, because it seeds the random number generators."""
+
+    def __init__(self, file_path: str, screen_size: tuple[int, int]):
+        self._file = open_gzip(file_path, "wt")
+        self._start = store.now()
+        seed = getrandbits(32)
+        store.random.seed(seed)
+        store.noise_random.seed(seed)
+        self._write({"seed": seed, "size": list(screen_size)})
+
+    def _write(self, record):
+        self._file.write(dumps(record, separators=(",", ":")) + "\n")
+
+    def record_event(self, event):
+        attributes = {
+            name: getattr(event, name)
+            for name in EVENT_ATTRIBUTES
+            if hasattr(event, name)
+        }
+        self._write(["e", round(store.now() - self._start, 6), event.type, attributes])
+
+    def record_midi(self, batch: list[tuple[int, int, int, float, int]]):
+        # midi timestamps are stored relative to the start of the trace as well
+        self._write(
+            [
+                "m",
+                round(store.now() - self._start, 6),
+                [
+                    [status, data1, data2, round(timestamp - self._start, 6), source]
+                    for status, data1, data2, timestamp, source in batch
+                ],
+            ]
+        )
+
+    def close(self):
+        self._file.close()
+
+
+class SimulatedClock:
+    """A clock that only moves when it is told to. Replays use it in place of `time.perf_counter`."""
+
+    def __init__(self):
+        self._time = 0.0
+
+    def now(self) -> float:
+        return self._time
+
+    def advance(self, seconds: float):
+        self._time += seconds
+
+
+def replay(
+    file_path: str,
+    speed: float = None,
+    frame_rate: int = 60,
+    tail: float = 2.0,
+    wave_path: str = None,
+) -> dict:
+    """Replay a trace headless and return a summary of the work it did.
+
+    The simulated clock always advances by one frame at a time, so the result doesn't depend on `speed`, which only paces the replay against the wall clock (None replays as fast as possible).
+    The audio and the number of objects drawn are hashed, so two replays of the same trace can be checked to be identical.
+    """
+    # the dummy drivers have to be selected before pygame initializes its display
+    environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from pygame import display, init
+    from pygame.event import Event
+
+    from app import App
+    from synth import AudioManager
+
+    with open_gzip(file_path, "rt") as f:
+        header = loads(f.readline())
+        records = [loads(line) for line in f]
+
+    clock = SimulatedClock()
+    store.now = clock.now
+    store.random.seed(header["seed"])
+    store.noise_random.seed(header["seed"])
+    store.particles.clear()
+    store.audio_manager = AudioManager(output=False)
+    store.profiler = FrameProfiler()
+    init()
+    store.screen = display.set_mode(header["size"])
+    app = App(midi_input=False)
+
+    frame_length = 1 / frame_rate
+    end = (records[-1][1] if records else 0.0) + tail
+    audio_hash = sha1()
+    work_hash = sha1()
+    audio_frames_due = 0.0
+    frames = 0
+    next_record = 0
+    wave_file = None
+    if wave_path is not None:
+        wave_file = open_wave(wave_path, "wb")
+        wave_file.setnchannels(1)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(store.audio_manager.sample_rate)
+    wall_start = perf_counter()
+
+    while clock.now() < end:
+        store.profiler.begin_frame()
+        # feed in the input that arrived before this frame
+        while next_record < len(records) and records[next_record][1] <= clock.now():
+            record = records[next_record]
+            if record[0] == "e":
+                app.process_event(Event(record[2], record[3]))
+            else:
+                batch = []
+                for message in record[2]:
+                    # the source is the number of the device, older traces had its name there or nothing at all
+                    source = message[4] if len(message) > 4 else 0
+                    batch.append((*message[:4], source if type(source) == int else 0))
+                app.piano.process_midi_batch(batch)
+            next_record += 1
+        store.profiler.mark("input")
+        app.update()
+        app.render(store.screen)
+        display.flip()
+        store.profiler.mark("flip")
+
+        # render the audio for this frame on the main thread instead of in a callback
+        audio_frames_due += frame_length * store.audio_manager.sample_rate
+        audio = store.audio_manager.render(int(audio_frames_due))
+        audio_frames_due -= int(audio_frames_due)
+        audio_hash.update(audio)
+        if wave_file is not None:
+            wave_file.writeframes(audio)
+        store.profiler.mark("audio")
+        work_hash.update(f"{app.piano.note_bar_count},{len(store.particles)};".encode())
+        store.profiler.end_frame()
+
+        frames += 1
+        clock.advance(frame_length)
+        if speed is not None:
+            # keep pace with the wall clock
+            delay = wall_start + clock.now() / speed - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+    if wave_file is not None:
+        wave_file.close()
+    p50, p95, p99 = store.profiler.percentiles()
+    return {
+        "frames": frames,
+        "records": len(records),
+        "audio_sha1": audio_hash.hexdigest(),
+        "work_sha1": work_hash.hexdigest(),
+        "wall_seconds": perf_counter() - wall_start,
+        "frame_ms": {"p50": p50 * 1000, "p95": p95 * 1000, "p99": p99 * 1000},
+        "stage_p95_ms": {
+            stage: store.profiler.percentiles(stage)[1] * 1000
+            for stage in store.profiler.stages
+        },
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Replay an input trace headless.")
+    parser.add_argument("trace")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument(
+        "--speed", type=float, default=1.0, help="replay speed against the wall clock"
+    )
+    pacing.add_argument(
+        "--fast", action="store_true", help="replay as fast as possible"
+    )
+    parser.add_argument("--wav", help="also write the replayed audio to a wav file")
+    parser.add_argument("--output", help="write the summary to a json file")
+    args = parser.parse_args()
+
+    summary = replay(args.trace, None if args.fast else args.speed, wave_path=args.wav)
+    print(
+        f"{summary['frames']} frames, p95 {summary['frame_ms']['p95']:.2f} ms, "
+        f"audio {summary['audio_sha1'][:12]}, work {summary['work_sha1'][:12]}"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
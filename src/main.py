@@ -1,3 +1,6 @@
+from argparse import ArgumentParser
+from threading import Thread
+
 from pygame import (
     DOUBLEBUF,
     FULLSCREEN,
@@ -7,7 +10,7 @@ from pygame import (
     QUIT,
     RESIZABLE,
     display,
-    init,
+    font,
 )
 from pygame import event as ev
 from pygame import image
@@ -15,28 +18,116 @@ from pygame.time import Clock
 
 import store
 from app import App
+from governor import LoadGovernor
+from input_trace import InputTrace
+from osc import OscServer
+from startup import Startup, read_assets
+from tracer import Tracer
+from tuning import Tuning
 
 
 def main():
-    # initialize pygame
-    init()
-    # initialize screen
-    store.screen = display.set_mode((800, 600), RESIZABLE | HWSURFACE | DOUBLEBUF)
-    display.set_caption("Interactive Piano Helper")
-    display.set_icon(image.load("assets/images/icon.png"))
+    parser = ArgumentParser(description="Interactive Piano Helper")
+    parser.add_argument("--play", metavar="FILE", help="play a midi file on start")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="playback speed of --play"
+    )
+    parser.add_argument(
+        "--record", metavar="FILE", help="record everything that is played (F5)"
+    )
+    parser.add_argument(
+        "--bounce", metavar="FILE", help="write the audio output to a wav file (F6)"
+    )
+    parser.add_argument(
+        "--capture-trace",
+        metavar="FILE",
+        help="record the input to a trace that can be replayed with input_trace.py",
+    )
+    tuning = parser.add_mutually_exclusive_group()
+    tuning.add_argument(
+        "--a4", type=float, help="tune to equal temperament with this A4 in Hz"
+    )
+    tuning.add_argument(
+        "--tuning", metavar="FILE", help="a MIDI Tuning Standard bulk dump (.syx)"
+    )
+    parser.add_argument(
+        "--startup-report",
+        metavar="FILE",
+        help="write the timings of the startup phases to a json file",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="trace every thread to a chrome trace json file, which can be opened in ui.perfetto.dev",
+    )
+    parser.add_argument(
+        "--osc-port",
+        type=int,
+        help="listen for notes over OSC on this UDP port on localhost, see osc.py",
+    )
+    args = parser.parse_args()
+    if args.trace:
+        store.tracer = Tracer()
+    store.startup = startup = Startup()
+    # the disk is read in the background while the window opens, so the assets load from memory later
+    startup.background("assets", read_assets, "assets")
+    if args.a4:
+        store.tuning = Tuning.equal_temperament(args.a4)
+    elif args.tuning:
+        store.tuning = Tuning.from_file(args.tuning)
+    with startup.phase("window"):
+        # only the parts of pygame that are used are initialized, the mixer would open an audio device of its own
+        display.init()
+        font.init()
+        store.screen = display.set_mode((800, 600), RESIZABLE | HWSURFACE | DOUBLEBUF)
+        display.set_caption("Interactive Piano Helper")
+        display.set_icon(image.load("assets/images/icon.png"))
+    with startup.phase("first frame"):
+        # show the background straight away instead of an empty window
+        store.screen.fill(store.COLOR_PALETTE["background"])
+        display.flip()
+    startup.milestone("first frame")
     fullscreen = False
     running = True
     # used to store previous window size when switching to fullscreen
     prev_size = (800, 600)
+    if args.capture_trace:
+        # the trace seeds the random number generators, so it has to start before the app
+        store.input_trace = InputTrace(args.capture_trace, store.screen.get_size())
     # initialize app context
-    app = App()
+    with startup.phase("app"):
+        app = App()
+    startup.background("audio", app.start_audio)
+    store.governor = LoadGovernor()
+    if args.osc_port:
+        Thread(
+            target=OscServer(args.osc_port).run, name="OscServerThread", daemon=True
+        ).start()
+    if args.play:
+        app.play_file(args.play, args.speed)
+    if args.record:
+        app.toggle_recording(args.record)
+    if args.bounce:
+        app.toggle_bounce(args.bounce)
     # clock to limit framerate
     clock = Clock()
     # main loop
     while running:
-        clock.tick(60)
+        store.profiler.begin_frame()
+        clock.tick(store.frame_cap)
+        store.profiler.mark("idle")
+        app.update()
         app.render(store.screen)
         display.flip()
+        store.profiler.mark("flip")
+        if not startup.reported:
+            startup.milestone("interactive")
+            if startup.finished:
+                if args.startup_report:
+                    startup.export(args.startup_report)
+                else:
+                    startup.report()
+                store.startup = None
         # process events
         for event in ev.get():
             if event.type == QUIT:
@@ -54,6 +145,18 @@ def main():
                     store.screen = display.set_mode(
                         prev_size, RESIZABLE | HWSURFACE | DOUBLEBUF
                     )
+        store.profiler.mark("events")
+        store.profiler.end_frame()
+        store.governor.update()
+    store.profiler.stop_export()
+    if store.recorder is not None:
+        store.recorder.stop()
+    if store.bounce is not None:
+        app.toggle_bounce()
+    if store.input_trace is not None:
+        store.input_trace.close()
+    if store.tracer is not None:
+        store.tracer.save(args.trace)
 
 
 if __name__ == "__main__":
@@ -1,62 +1,256 @@
 from math import floor
-from queue import Queue
-from time import sleep
+from time import perf_counter, sleep
 
 from pygame import midi
 
 import store
+from events import BusEvent, EventKind
+from startup import startup_phase
 
 
 class MidiDeviceProcessor:
+    """Reads midi messages from one input device."""
 
     _midi_input: midi.Input
 
-    def __init__(self, event_queue: Queue):
-        # initialize midi input
-        midi.init()
-        self._midi_input = None
-        self._event_queue = event_queue
-        self.find_device()
-        if self._midi_input is None:
-            return
+    # the most messages read from the device in one call
+    BATCH_SIZE = 64
+
+    def __init__(self, device_id: int, name: str, source: int):
+        self._midi_input = midi.Input(device_id)
+        self._name = name
+        self._source = source
+        # the notes that are held and the channels whose sustain pedal is down, the device isn't closed for a rescan while there are any
+        self._held_notes = set()
+        self._sustained_channels = set()
+
+    def read_batch(self, clock_offset: float) -> list[tuple[int, int, int, float, int]]:
+        """Read every message that is waiting on the device, tagged with its source number. `clock_offset` is added to the midi clock's timestamps to turn them into `time.perf_counter` seconds."""
+        start = perf_counter()
+        batch = []
+        while self._midi_input.poll():
+            # pygame gives us [[status, data1, data2, data3], timestamp] for each message
+            batch.extend(
+                (
+                    data[0],
+                    data[1],
+                    data[2],
+                    timestamp / 1000 + clock_offset,
+                    self._source,
+                )
+                for data, timestamp in self._midi_input.read(self.BATCH_SIZE)
+            )
+        for status, data1, data2, _, _ in batch:
+            self._track(status, data1, data2)
+        # most polls don't read anything, so only the ones that did are traced
+        if batch and store.tracer is not None:
+            store.tracer.complete(
+                "midi read", start, perf_counter(), {"device": self._name}
+            )
+        return batch
+
+    def _track(self, status: int, data1: int, data2: int):
+        kind = status & 0xF0
+        channel = status & 0x0F
+        # a note on with a velocity of 0 is a note off
+        if kind == 0x90 and data2 > 0:
+            self._held_notes.add((channel, data1))
+        elif kind in (0x80, 0x90):
+            self._held_notes.discard((channel, data1))
+        elif kind == 0xB0 and data1 == 64:
+            if data2 >= 64:
+                self._sustained_channels.add(channel)
+            else:
+                self._sustained_channels.discard(channel)
+        elif kind == 0xB0 and data1 in (120, 123):
+            # all sound off and all notes off
+            self._held_notes = {note for note in self._held_notes if note[0] != channel}
+
+    def close(self):
+        self._midi_input.close()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def source(self) -> int:
+        return self._source
+
+    @property
+    def holding(self) -> bool:
+        """Whether any note is held or sustained on the device."""
+        return bool(self._held_notes or self._sustained_channels)
+
+
+class MidiInputManager:
+    """Polls every midi input device from a single thread and publishes their messages on `store.event_bus`.
+
+    Every message that is waiting is read at once and published together as `EventKind.MIDI` events, whose timestamp is when the device received the message in `time.perf_counter` seconds.
+    The source of each event numbers the device it came from, and `source_names` has the name of each number.
+    The devices are rescanned every few seconds, so they can be plugged in and out while the app is running.
+    """
+
+    # the time to wait between polls shrinks to the minimum while messages are arriving and grows back to the maximum while idle
+    MIN_POLL_INTERVAL = 0.001
+    MAX_POLL_INTERVAL = 0.01
+    # portmidi only looks for new devices when it is initialized, so rescanning means closing every device for a moment
+    # it only happens after the devices have been quiet for a while and nothing is held, so that no note off is lost and no held note is timed against a restarted midi clock
+    RESCAN_INTERVAL = 3.0
+    RESCAN_AFTER_IDLE = 1.0
+
+    def __init__(self):
+        # devices are keyed by their name and how many devices before them have the same name, so identical controllers are told apart
+        self._devices: dict[tuple[str, int], MidiDeviceProcessor] = {}
+        # every device gets a number the first time it is found and keeps it when it is reconnected. 0 is left for messages that don't come from a midi device
+        self._sources: dict[tuple[str, int], int] = {}
+        self._source_names = [""]
+        self._poll_interval = self.MAX_POLL_INTERVAL
+        # the difference between perf_counter and the midi clock, in seconds
+        self._clock_offset = float("inf")
+        self._last_rescan = 0.0
+        self._last_message = 0.0
+
+    def run(self):
+        with startup_phase("midi"):
+            midi.init()
+            self.rescan()
         while True:
-            sleep(0.01)
-            if self._midi_input.poll():
-                self._event_queue.put(self._midi_input.read(1))
+            sleep(self._poll_interval)
+            now = perf_counter()
+            batch = self.read_batch()
+            if batch:
+                store.event_bus.publish_batch(
+                    [
+                        BusEvent(
+                            EventKind.MIDI, status, data1, data2, timestamp, source
+                        )
+                        for status, data1, data2, timestamp, source in batch
+                    ]
+                )
+                self._poll_interval = self.MIN_POLL_INTERVAL
+                self._last_message = now
+            else:
+                self._poll_interval = min(
+                    self._poll_interval * 2, self.MAX_POLL_INTERVAL
+                )
+                if (
+                    now - self._last_rescan > self.RESCAN_INTERVAL
+                    and now - self._last_message > self.RESCAN_AFTER_IDLE
+                    and not any(device.holding for device in self._devices.values())
+                ):
+                    self.rescan()
 
-    def find_device(self):
-        in_id = midi.get_default_input_id()
-        if in_id != -1:
-            print("Found default midi input device")
-            self._midi_input = midi.Input(in_id)
-        else:
-            print("No default midi input device found")
-            self._midi_input = None
+    def read_batch(self) -> list[tuple[int, int, int, float, int]]:
+        """Read every message that is waiting on every device."""
+        if not self._devices:
+            return []
+        # the midi clock only counts whole milliseconds, so the smallest difference seen is the most accurate one
+        self._clock_offset = min(
+            self._clock_offset, perf_counter() - midi.time() / 1000
+        )
+        batch = []
+        for key, device in list(self._devices.items()):
+            try:
+                batch.extend(device.read_batch(self._clock_offset))
+            except midi.MidiException:
+                # the device was probably unplugged, the next rescan will pick it up again if it comes back
+                print(f"Lost midi input device {device.name}")
+                del self._devices[key]
+        return batch
+
+    def rescan(self):
+        for device in self._devices.values():
+            device.close()
+        midi.quit()
+        midi.init()
+        # the midi clock starts again from zero when it is initialized
+        self._clock_offset = float("inf")
+        self._last_rescan = perf_counter()
+
+        devices = {}
+        occurrences: dict[str, int] = {}
+        for device_id in range(midi.get_count()):
+            _, name, is_input, _, _ = midi.get_device_info(device_id)
+            if not is_input:
+                continue
+            name = name.decode(errors="replace")
+            key = (name, occurrences.get(name, 0))
+            occurrences[name] = key[1] + 1
+            if key[1]:
+                name = f"{name} #{key[1] + 1}"
+            if key not in self._sources:
+                self._sources[key] = len(self._source_names)
+                self._source_names.append(name)
+            try:
+                devices[key] = MidiDeviceProcessor(device_id, name, self._sources[key])
+            except midi.MidiException:
+                continue
+            if key not in self._devices:
+                print(f"Found midi input device {name}")
+        for key, device in self._devices.items():
+            if key not in devices:
+                print(f"Midi input device {device.name} was disconnected")
+        self._devices = devices
+
+    @property
+    def devices(self) -> list[str]:
+        return [device.name for device in self._devices.values()]
+
+    @property
+    def source_names(self) -> list[str]:
+        """The name of the device of every source number that has been published, including devices that have been disconnected since."""
+        return self._source_names
 
 
 class Note:
+    """A midi note and the velocity it was played with. Notes are immutable and interned: there is one instance for each of the 128 x 128 note and velocity pairs, and `Note(note, velocity)` returns it instead of making a new one."""
+
+    __slots__ = ("_note", "_velocity")
+
     notes = [
         ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"],
         ["C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B"],
     ]
 
-    def __init__(self, note: int, velocity: int):
+    # every note, indexed by note * 128 + velocity
+    _table: list["Note"] = []
+
+    def __new__(cls, note: int, velocity: int):
         if type(note) != int:
             raise TypeError("Note must be an integer")
         if note < 0 or note > 127:
             raise ValueError("Note must be between 0 and 127")
         if velocity < 0 or velocity > 127:
             raise ValueError("Velocity must be between 0 and 127")
-        self._note = note
-        self._velocity = velocity
+        return cls._table[note << 7 | int(velocity)]
+
+    @classmethod
+    def _build_table(cls):
+        for index in range(128 * 128):
+            note = object.__new__(cls)
+            object.__setattr__(note, "_note", index >> 7)
+            object.__setattr__(note, "_velocity", index & 0x7F)
+            cls._table.append(note)
+
+    def __setattr__(self, name, value):
+        # the same instance is shared by everything that plays this note
+        raise AttributeError("Notes are immutable")
 
     def __str__(self):
         return self.notes[0][self._note % 12] + str(floor(self._note / 12) - 1)
 
+    def __repr__(self):
+        return f"Note({self._note}, {self._velocity})"
+
+    def __reduce__(self):
+        # unpickling goes through the table as well
+        return (Note, (self._note, self._velocity))
+
     @property
     def freq(self) -> float:
-        # https://en.wikipedia.org/wiki/MIDI_tuning_standard
-        return 440 * 2 ** ((float(self._note) - 69) / 12)
+        """The frequency of the note in the current tuning."""
+        return store.tuning.frequencies[self._note]
 
     @property
     def note(self):
@@ -65,3 +259,6 @@ class Note:
     @property
     def velocity(self):
         return self._velocity
+
+
+Note._build_table()
@@ -0,0 +1,294 @@
+"""Streaming reader and player for Standard MIDI Files.
+
+Files are parsed lazily: each track is read in small blocks as its events are needed, and the tracks are merged with a heap, so only one event per track is in memory at a time.
+Render a file to a wav file faster than real time with:
+
+    python src/midi_file.py song.mid song.wav
+"""
+
+from heapq import merge
+from struct import pack, unpack
+from sys import argv
+from time import perf_counter
+from wave import open as open_wave
+
+import store
+from midi import Note
+
+# the tempo until a file sets one, in microseconds per quarter note (120 bpm)
+DEFAULT_TEMPO = 500000
+
+
+class MidiFileError(Exception):
+    pass
+
+
+class _ChunkReader:
+    """Reads the bytes of one chunk of a file in blocks, so that a track never has to be loaded all at once."""
+
+    BLOCK_SIZE = 4096
+
+    def __init__(self, file_path: str, offset: int, length: int):
+        self._file = open(file_path, "rb")
+        self._file.seek(offset)
+        self._remaining = length
+        self._buffer = b""
+        self._index = 0
+
+    def _fill(self):
+        if self._remaining <= 0:
+            raise EOFError
+        self._buffer = self._file.read(min(self.BLOCK_SIZE, self._remaining))
+        if not self._buffer:
+            raise EOFError
+        self._remaining -= len(self._buffer)
+        self._index = 0
+
+    def byte(self) -> int:
+        if self._index >= len(self._buffer):
+            self._fill()
+        value = self._buffer[self._index]
+        self._index += 1
+        return value
+
+    def read(self, length: int) -> bytes:
+        return bytes(self.byte() for _ in range(length))
+
+    def skip(self, length: int):
+        for _ in range(length):
+            self.byte()
+
+    def variable_length(self) -> int:
+        # 7 bits per byte, the top bit is set on every byte except the last
+        value = 0
+        while True:
+            byte = self.byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+
+    def close(self):
+        self._file.close()
+
+
+def read_track(file_path: str, offset: int, length: int):
+    """Yield the channel messages and tempo changes of one track as `(tick, status, data1, data2)` tuples. Tempo changes have a status of 0xFF, and the tempo in microseconds per quarter note as data1."""
+    reader = _ChunkReader(file_path, offset, length)
+    tick = 0
+    running_status = None
+    try:
+        while True:
+            tick += reader.variable_length()
+            status = reader.byte()
+            if status < 0x80:
+                # running status, the byte we just read is the first data byte
+                if running_status is None:
+                    raise MidiFileError("Data byte without a status byte")
+                data1 = status
+                status = running_status
+            elif status == 0xFF:
+                meta_type = reader.byte()
+                data = reader.read(reader.variable_length())
+                if meta_type == 0x51 and len(data) == 3:
+                    yield (tick, 0xFF, int.from_bytes(data, "big"), 0)
+                elif meta_type == 0x2F:
+                    return
+                continue
+            elif status in (0xF0, 0xF7):
+                # system exclusive messages aren't used by the piano
+                reader.skip(reader.variable_length())
+                continue
+            else:
+                running_status = status
+                data1 = reader.byte()
+            # program change and channel pressure only have one data byte
+            data2 = 0 if status & 0xF0 in (0xC0, 0xD0) else reader.byte()
+            yield (tick, status, data1, data2)
+    except EOFError:
+        return
+    finally:
+        reader.close()
+
+
+def read_midi_file(file_path: str):
+    """Yield the channel messages of a midi file in order as `(time, status, data1, data2)` tuples, where time is in seconds from the start of the file."""
+    with open(file_path, "rb") as f:
+        chunk_type, length = unpack(">4sI", f.read(8))
+        if chunk_type != b"MThd":
+            raise MidiFileError(f"{file_path} is not a midi file")
+        _, track_count, division = unpack(">HHh", f.read(6))
+        f.seek(8 + length)
+        # only the positions of the tracks are read up front
+        tracks = []
+        while len(tracks) < track_count:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_type, length = unpack(">4sI", header)
+            if chunk_type == b"MTrk":
+                tracks.append((f.tell(), length))
+            f.seek(length, 1)
+
+    if division < 0:
+        # smpte division: frames per second and ticks per frame, the tempo doesn't matter
+        seconds_per_tick = 1 / (-(division >> 8) * (division & 0xFF))
+        ticks_per_quarter = None
+    else:
+        ticks_per_quarter = division
+        seconds_per_tick = DEFAULT_TEMPO / 1000000 / ticks_per_quarter
+
+    # the tempo can change in any track, so the time is worked out as the merged events come in
+    last_tick = 0
+    time = 0.0
+    for tick, status, data1, data2 in merge(
+        *(read_track(file_path, offset, length) for offset, length in tracks),
+        key=lambda event: event[0],
+    ):
+        time += (tick - last_tick) * seconds_per_tick
+        last_tick = tick
+        if status == 0xFF:
+            if ticks_per_quarter is not None:
+                seconds_per_tick = data1 / 1000000 / ticks_per_quarter
+            continue
+        yield (time, status, data1, data2)
+
+
+class MidiFilePlayer:
+    """Plays a midi file through a `Piano` in real time. `update` should be called every frame, and each message is passed to the piano with the timestamp it should be heard at, so the audio engine can start it at the exact frame."""
+
+    def __init__(self, file_path: str, piano, speed: float = 1.0):
+        self._events = read_midi_file(file_path)
+        self._next_event = next(self._events, None)
+        self._piano = piano
+        self._speed = speed
+        self._start_time = None
+        self._last_update = None
+
+    def update(self):
+        from synth import SCHEDULING_LATENCY
+
+        now = store.now()
+        if self._start_time is None:
+            self._start_time = self._last_update = now
+        # the messages that are due before the next frame plus the audio's latency are passed on now, so none of them start late because they fell between two frames
+        horizon = now + min(now - self._last_update, 0.1) + SCHEDULING_LATENCY
+        self._last_update = now
+        while self._next_event is not None:
+            time, status, data1, data2 = self._next_event
+            timestamp = self._start_time + time / self._speed
+            if timestamp > horizon:
+                break
+            self._piano.process_midi_message(status, data1, data2, timestamp)
+            self._next_event = next(self._events, None)
+
+    @property
+    def finished(self) -> bool:
+        return self._next_event is None
+
+
+class MidiFileWriter:
+    """Writes a single track midi file as events come in. The length of the track is only known at the end, so it is filled in when the file is closed."""
+
+    # with a tempo of 120 bpm this makes one tick a millisecond
+    TICKS_PER_QUARTER = 500
+
+    def __init__(self, file_path: str):
+        self._file = open(file_path, "wb")
+        self._file.write(b"MThd" + pack(">IHHH", 6, 0, 1, self.TICKS_PER_QUARTER))
+        self._file.write(b"MTrk" + pack(">I", 0))
+        self._track_start = self._file.tell()
+        self._last_time = 0
+        self._file.write(b"\x00\xff\x51\x03" + DEFAULT_TEMPO.to_bytes(3, "big"))
+
+    @staticmethod
+    def _variable_length(value: int) -> bytes:
+        # 7 bits per byte, the top bit is set on every byte except the last
+        data = bytearray([value & 0x7F])
+        value >>= 7
+        while value:
+            data.insert(0, (value & 0x7F) | 0x80)
+            value >>= 7
+        return bytes(data)
+
+    def encode(self, milliseconds: int, status: int, data1: int, data2: int) -> bytes:
+        """Encode an event without writing it. Events have to be encoded in order, because each one is stored relative to the last."""
+        delta = max(0, milliseconds - self._last_time)
+        self._last_time += delta
+        return self._variable_length(delta) + bytes((status, data1, data2))
+
+    def write(self, data: bytes):
+        self._file.write(data)
+
+    def close(self):
+        self._file.write(self._variable_length(0) + b"\xff\x2f\x00")
+        length = self._file.tell() - self._track_start
+        self._file.seek(self._track_start - 4)
+        self._file.write(pack(">I", length))
+        self._file.close()
+
+
+def render_midi_file(
+    file_path: str,
+    wave_path: str,
+    instrument_audio=None,
+    block_length: int = 1024,
+):
+    """Render a midi file to a wav file as fast as the synthesizer can go. Every note starts at its exact frame, because audio is only rendered up to the next event before the event is applied."""
+    # the audio engine is only imported here so that reading files doesn't need an audio device
+    from synth import AudioManager, InstrumentAudio, SquareSynth
+
+    audio_manager = AudioManager(output=False)
+    if instrument_audio is None:
+        # sounds the same as the piano
+        instrument_audio = InstrumentAudio(SquareSynth, (0.1, 0.1, 0.5, 0.3))
+    audio_manager.add_instrument_audio(instrument_audio)
+    sample_rate = audio_manager.sample_rate
+
+    sustain = False
+    sustained_notes = set()
+    frame = 0
+    with open_wave(wave_path, "wb") as wave_file:
+        wave_file.setnchannels(1)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(sample_rate)
+
+        def render_until(target: int):
+            nonlocal frame
+            while frame < target:
+                length = min(block_length, target - frame)
+                wave_file.writeframes(audio_manager.render(length))
+                frame += length
+
+        for time, status, data1, data2 in read_midi_file(file_path):
+            render_until(round(time * sample_rate))
+            kind = status & 0xF0
+            if kind == 0x90 and data2 > 0:
+                instrument_audio.play(Note(data1, data2))
+            elif kind in (0x80, 0x90):
+                if sustain:
+                    sustained_notes.add(data1)
+                else:
+                    instrument_audio.release(data1)
+            elif kind == 0xB0 and data1 == 64:
+                sustain = data2 >= 64
+                if not sustain:
+                    for note in sustained_notes:
+                        instrument_audio.release(note)
+                    sustained_notes.clear()
+        # let the last notes ring out
+        for note in range(128):
+            instrument_audio.release(note)
+        render_until(frame + sample_rate)
+    return frame / sample_rate
+
+
+if __name__ == "__main__":
+    if len(argv) != 3:
+        print(f"Usage: python {argv[0]} input.mid output.wav")
+    else:
+        start = perf_counter()
+        duration = render_midi_file(argv[1], argv[2])
+        elapsed = perf_counter() - start
+        print(
+            f"Rendered {duration:.1f} s of audio in {elapsed:.1f} s ({duration / elapsed:.1f}x real time)"
+        )
@@ -0,0 +1,358 @@
+"""Receive notes from other programs on the same computer over OSC (Open Sound Control) on UDP.
+
+Every packet is turned into midi messages and published on `store.event_bus` like the messages of a midi device, so they are played by the piano on the main thread. The addresses are:
+
+    /note/on note velocity
+    /note/off note
+    /cc controller value
+    /midi status data1 data2
+
+Messages can be sent one per packet or batched in bundles. The notes of a bundle with a time tag play at that time, and everything else plays when it arrives.
+One asyncio event loop on one thread serves every client. Run `python src/osc.py` to send notes to the app, or `python src/osc.py --self-test` to check that the server keeps up.
+"""
+
+from argparse import ArgumentParser
+from asyncio import DatagramProtocol, Event, get_running_loop, run, sleep
+from math import isfinite
+from struct import Struct, pack
+from struct import error as StructError
+from sys import exit
+from time import perf_counter, time
+
+import store
+from events import BusEvent, EventKind
+
+DEFAULT_PORT = 57120
+# seconds between the NTP epoch (1900) used by OSC time tags and the unix epoch (1970)
+NTP_EPOCH_OFFSET = 2208988800
+# a time tag of 1 means "as soon as possible"
+IMMEDIATELY = 1
+# timed notes are held back until this many seconds before they are due, which leaves time for them to reach the audio thread and start at their exact frame
+SCHEDULE_AHEAD = 0.01
+
+INT32 = Struct(">i")
+FLOAT32 = Struct(">f")
+TIME_TAG = Struct(">Q")
+
+
+class OscError(Exception):
+    pass
+
+
+def _read_string(data: bytes, offset: int) -> tuple[str, int]:
+    end = data.find(b"\0", offset)
+    if end < 0:
+        raise OscError("Unterminated string")
+    # strings are padded with zeros to a multiple of 4 bytes
+    return data[offset:end].decode("ascii", "replace"), (end + 4) & ~3
+
+
+def decode_message(data: bytes) -> tuple[str, list]:
+    """The address and arguments of an OSC message."""
+    address, offset = _read_string(data, 0)
+    if not address.startswith("/"):
+        raise OscError(f"Not an OSC address: {address!r}")
+    if offset >= len(data):
+        # very old clients leave out the type tags when there are no arguments
+        return address, []
+    tags, offset = _read_string(data, offset)
+    if not tags.startswith(","):
+        raise OscError("Missing type tags")
+    arguments = []
+    try:
+        for tag in tags[1:]:
+            if tag == "i":
+                arguments.append(INT32.unpack_from(data, offset)[0])
+                offset += 4
+            elif tag == "f":
+                arguments.append(FLOAT32.unpack_from(data, offset)[0])
+                offset += 4
+            elif tag == "s":
+                value, offset = _read_string(data, offset)
+                arguments.append(value)
+            elif tag in "TF":
+                arguments.append(tag == "T")
+            else:
+                raise OscError(f"Unsupported type tag {tag!r}")
+    except StructError:
+        raise OscError("Message is shorter than its type tags")
+    return address, arguments
+
+
+def decode_packet(data: bytes, time_tag: int = IMMEDIATELY):
+    """Yield `(time tag, address, arguments)` for every message in a packet, including those in nested bundles."""
+    if not data.startswith(b"#bundle\0"):
+        yield time_tag, *decode_message(data)
+        return
+    if len(data) < 16:
+        raise OscError("Bundle without a time tag")
+    time_tag = TIME_TAG.unpack_from(data, 8)[0]
+    offset = 16
+    while offset < len(data):
+        if offset + 4 > len(data):
+            raise OscError("Truncated bundle element")
+        size = INT32.unpack_from(data, offset)[0]
+        offset += 4
+        if size <= 0 or offset + size > len(data):
+            raise OscError("Bundle element is larger than the bundle")
+        yield from decode_packet(data[offset : offset + size], time_tag)
+        offset += size
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (4 - len(data) % 4)
+
+
+def encode_message(address: str, *arguments) -> bytes:
+    """An OSC message with int, float, string and bool arguments."""
+    tags = ","
+    encoded = b""
+    for argument in arguments:
+        if isinstance(argument, bool):
+            tags += "T" if argument else "F"
+        elif isinstance(argument, int):
+            tags += "i"
+            encoded += INT32.pack(argument)
+        elif isinstance(argument, float):
+            tags += "f"
+            encoded += FLOAT32.pack(argument)
+        else:
+            tags += "s"
+            encoded += _pad(str(argument).encode("ascii"))
+    return _pad(address.encode("ascii")) + _pad(tags.encode("ascii")) + encoded
+
+
+def encode_bundle(messages: list[bytes], time_tag: int = IMMEDIATELY) -> bytes:
+    return (
+        b"#bundle\0"
+        + TIME_TAG.pack(time_tag)
+        + b"".join(pack(">i", len(message)) + message for message in messages)
+    )
+
+
+def time_tag_from_unix(seconds: float) -> int:
+    """The OSC time tag of a unix time, as 32 bits of seconds and 32 bits of fractions of a second since 1900."""
+    return int((seconds + NTP_EPOCH_OFFSET) * (1 << 32))
+
+
+def _midi_message(address: str, arguments: list) -> tuple[int, int, int] | None:
+    for argument in arguments[:3]:
+        # arguments can be ints or floats depending on the client, anything else can't be a midi value
+        if isinstance(argument, bool) or not isinstance(argument, (int, float)):
+            raise OscError(f"{address} has a {type(argument).__name__} argument")
+        if not isfinite(argument):
+            raise OscError(f"{address} has a {argument} argument")
+    # midi only has 7 bit values
+    values = [int(argument) & 0x7F for argument in arguments[:3]]
+    if address == "/note/on" and len(values) >= 1:
+        return 0x90, values[0], values[1] if len(values) >= 2 else 100
+    if address == "/note/off" and len(values) >= 1:
+        return 0x80, values[0], 0
+    if address == "/cc" and len(values) >= 2:
+        return 0xB0, values[0], values[1]
+    if address == "/midi" and len(values) >= 3:
+        # the status byte is the only value that uses the 8th bit
+        return int(arguments[0]) & 0xFF, values[1], values[2]
+    return None
+
+
+class OscProtocol(DatagramProtocol):
+    """Decodes every packet as it arrives and publishes its notes as one batch."""
+
+    def __init__(self):
+        self._packets = 0
+        self._ignored = 0
+
+    def datagram_received(self, data: bytes, address):
+        received = perf_counter()
+        # the difference between the clock the time tags are in and the clock the app runs on
+        clock_offset = received - time()
+        # the messages of each time tag in the packet, which is usually only one
+        batches: dict[int, list[BusEvent]] = {}
+        try:
+            for time_tag, osc_address, arguments in decode_packet(data):
+                message = _midi_message(osc_address, arguments)
+                if message is None:
+                    self._ignored += 1
+                    continue
+                timestamp = received
+                if time_tag != IMMEDIATELY:
+                    # notes that are already late play straight away
+                    timestamp = max(
+                        received,
+                        time_tag / (1 << 32) - NTP_EPOCH_OFFSET + clock_offset,
+                    )
+                batches.setdefault(time_tag, []).append(
+                    BusEvent(EventKind.MIDI, *message, timestamp)
+                )
+        except OscError as error:
+            self._ignored += 1
+            print(f"Ignored an OSC packet from {address[0]}:{address[1]}: {error}")
+            return
+        self._packets += 1
+        for batch in batches.values():
+            delay = batch[0].timestamp - received - SCHEDULE_AHEAD
+            if delay > 0:
+                # the event loop holds on to notes that are sent ahead of time, so the piano shows them when they play
+                get_running_loop().call_later(
+                    delay, store.event_bus.publish_batch, batch
+                )
+            else:
+                store.event_bus.publish_batch(batch)
+
+    @property
+    def packets(self) -> int:
+        return self._packets
+
+    @property
+    def ignored(self) -> int:
+        return self._ignored
+
+
+class OscServer:
+    """Listens for OSC packets on localhost. `run` blocks, so it is run on a thread of its own like the midi input."""
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = "127.0.0.1"):
+        self._host = host
+        self._port = port
+        self._protocol = OscProtocol()
+        self._stopped = None
+
+    def run(self):
+        run(self.serve())
+
+    async def serve(self, ready: Event = None):
+        """Serve until `stop` is called. `ready` is set once the socket is bound."""
+        self._stopped = Event()
+        transport, _ = await get_running_loop().create_datagram_endpoint(
+            lambda: self._protocol, local_addr=(self._host, self._port)
+        )
+        print(f"Listening for OSC on {self._host}:{self._port}")
+        if ready is not None:
+            ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            transport.close()
+
+    def stop(self):
+        """Stop serving, called from the server's own event loop."""
+        if self._stopped is not None:
+            self._stopped.set()
+
+    @property
+    def protocol(self) -> OscProtocol:
+        return self._protocol
+
+
+async def self_test(port: int, notes: int = 20000, bundle_size: int = 16) -> dict:
+    """Send `notes` note ons and offs in bundles to a server on the same event loop and measure how many arrive and how long they take."""
+    received = store.event_bus.subscribe("osc self test", EventKind.MIDI)
+    server = OscServer(port)
+    ready = Event()
+    loop = get_running_loop()
+    serving = loop.create_task(server.serve(ready))
+    await ready.wait()
+    transport, _ = await loop.create_datagram_endpoint(
+        DatagramProtocol, remote_addr=("127.0.0.1", port)
+    )
+    start = perf_counter()
+    latencies = []
+    events = 0
+    for first in range(0, notes, bundle_size):
+        messages = []
+        for note in range(first, min(first + bundle_size, notes)):
+            messages.append(encode_message("/note/on", 36 + note % 60, 100))
+            messages.append(encode_message("/note/off", 36 + note % 60))
+        sent = perf_counter()
+        transport.sendto(encode_bundle(messages))
+        # give the server a turn, as a client on another process would, so the socket buffer doesn't overflow
+        await sleep(0)
+        for event in received.drain():
+            events += 1
+            latencies.append(event.timestamp - sent)
+    # wait for the last packets
+    await sleep(0.05)
+    events += len(received.drain())
+    elapsed = perf_counter() - start
+    # packets with arguments that aren't midi values are ignored rather than raising out of the protocol
+    ignored = server.protocol.ignored
+    transport.sendto(encode_message("/note/on", "C4", 100))
+    transport.sendto(encode_message("/note/on", float("nan"), 100))
+    await sleep(0.05)
+    malformed_ignored = server.protocol.ignored - ignored
+    malformed_played = len(received.drain())
+    transport.close()
+    server.stop()
+    await serving
+    store.event_bus.unsubscribe(received)
+    latencies.sort()
+    return {
+        "sent": notes * 2,
+        "received": events,
+        "malformed_ignored": malformed_ignored,
+        "malformed_played": malformed_played,
+        "events_per_second": events / elapsed,
+        "p50_latency_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        "p99_latency_ms": (
+            latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        ),
+    }
+
+
+async def send_scale(port: int, bpm: int = 240):
+    """Play a c major scale on the app, with the notes scheduled in time tagged bundles."""
+    loop = get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        DatagramProtocol, remote_addr=("127.0.0.1", port)
+    )
+    beat = 60 / bpm
+    # the notes are sent a little ahead of time, so the app plays them exactly on the beat
+    start = time() + 0.1
+    for i, note in enumerate([60, 62, 64, 65, 67, 69, 71, 72]):
+        transport.sendto(
+            encode_bundle(
+                [encode_message("/note/on", note, 90)],
+                time_tag_from_unix(start + i * beat),
+            )
+        )
+        transport.sendto(
+            encode_bundle(
+                [encode_message("/note/off", note)],
+                time_tag_from_unix(start + (i + 0.9) * beat),
+            )
+        )
+    transport.close()
+
+
+def main():
+    parser = ArgumentParser(description="Send notes to the app over OSC.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--self-test",
+        action="store_true",
+        help="run a server and a client in this process and report the throughput",
+    )
+    args = parser.parse_args()
+    if args.self_test:
+        results = run(self_test(args.port))
+        print(
+            f"Received {results['received']} of {results['sent']} events,"
+            f" {results['events_per_second']:.0f} events/s,"
+            f" latency p50 {results['p50_latency_ms']:.3f} ms, p99 {results['p99_latency_ms']:.3f} ms"
+        )
+        print(
+            f"Ignored {results['malformed_ignored']} of 2 malformed packets, played {results['malformed_played']}"
+        )
+        if (
+            results["received"] != results["sent"]
+            or results["malformed_ignored"] != 2
+            or results["malformed_played"]
+        ):
+            exit(1)
+    else:
+        run(send_scale(args.port))
+
+
+if __name__ == "__main__":
+    main()
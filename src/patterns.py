@@ -0,0 +1,46 @@
+"""Accompaniment styles as data.
+
+A style has a pattern for each auto instrument, and a pattern is the list of steps that instrument plays in one measure of 16 ticks (16th notes).
+Each step is `(tick, tones, velocity, length, probability)`:
+
+- tick: when the step starts in the measure, from 0 to 15
+- tones: the tones to pick one from at random. For drums a tone is a midi note, for the other instruments it is an index into the notes of the current chord (0 is the root, 1 the third, 2 the fifth and 3 the seventh)
+- velocity: how hard the note is played
+- length: how long the note is held, in ticks
+- probability: the chance that the step is played at all
+"""
+
+BEATS = (0, 4, 8, 12)
+
+STYLES = {
+    "basic": {
+        "drums": (
+            # a snare every beat
+            [(tick, (12,), 40, 0.16, 1.0) for tick in BEATS]
+            # a hat every 8th note that isn't a beat, and sometimes on 16th notes
+            + [(tick, (13,), 20, 0.4, 1.0) for tick in (2, 6, 10, 14)]
+            + [(tick, (13,), 20, 0.4, 0.5) for tick in range(1, 16, 2)]
+        ),
+        "chords": [
+            (tick, (tone,), velocity, 4, 1.0)
+            for tick in BEATS
+            for tone, velocity in zip(range(4), (80, 60, 55, 50))
+        ],
+        "bass": (
+            # the root on the first beat of the measure
+            [(0, (0,), 127, 4, 1.0)]
+            # on other beats, half the time, mostly the root and otherwise the third or fifth
+            + [(tick, (0, 0, 0, 0, 1, 2), 127, 4, 0.5) for tick in BEATS[1:]]
+        ),
+    },
+    "half time": {
+        "drums": [(tick, (12,), 40, 0.16, 1.0) for tick in (0, 8)]
+        + [(tick, (13,), 20, 0.4, 1.0) for tick in (2, 4, 6, 10, 12, 14)],
+        "chords": [
+            (tick, (tone,), velocity, 8, 1.0)
+            for tick in (0, 8)
+            for tone, velocity in zip(range(4), (70, 55, 50, 45))
+        ],
+        "bass": [(0, (0,), 127, 6, 1.0), (8, (2,), 110, 6, 1.0)],
+    },
+}
@@ -0,0 +1,103 @@
+from collections import deque
+from json import dumps
+from time import perf_counter
+
+import store
+
+
+class FrameProfiler:
+    """Times the stages of each frame and keeps rolling percentiles of them. Stages are timed as laps, so marking a stage costs a single clock read."""
+
+    def __init__(self, window: int = 300):
+        # the number of frames the percentiles are calculated over
+        self._window = window
+        self._stages: dict[str, deque] = {}
+        self._current: dict[str, float] = {}
+        self._frame_start = perf_counter()
+        self._lap_start = self._frame_start
+        self._frame_times = deque(maxlen=window)
+        self._frames = 0
+        self._busy_time = 0.0
+        self._export_file = None
+
+    def begin_frame(self):
+        self._frame_start = perf_counter()
+        self._lap_start = self._frame_start
+
+    def mark(self, stage: str):
+        """Record the time since the last mark as the duration of `stage`."""
+        now = perf_counter()
+        if store.tracer is not None:
+            store.tracer.complete(stage, self._lap_start, now)
+        # stages can be marked more than once a frame, e.g. when there are several sources of the same work
+        self._current[stage] = self._current.get(stage, 0.0) + now - self._lap_start
+        self._lap_start = now
+
+    def end_frame(self):
+        frame_time = perf_counter() - self._frame_start
+        self._frame_times.append(frame_time)
+        self._busy_time = frame_time - self._current.get("idle", 0.0)
+        for stage, duration in self._current.items():
+            if stage not in self._stages:
+                self._stages[stage] = deque(maxlen=self._window)
+            self._stages[stage].append(duration)
+        if self._export_file is not None:
+            self._export_row(frame_time)
+        self._current.clear()
+        self._frames += 1
+
+    def percentiles(self, stage: str = None) -> tuple[float, float, float]:
+        """The p50, p95 and p99 duration of a stage in seconds, or of the whole frame if no stage is given."""
+        samples = self._frame_times if stage is None else self._stages.get(stage)
+        if not samples:
+            return (0.0, 0.0, 0.0)
+        samples = sorted(samples)
+        last = len(samples) - 1
+        return (
+            samples[round(last * 0.5)],
+            samples[round(last * 0.95)],
+            samples[round(last * 0.99)],
+        )
+
+    @property
+    def stages(self) -> list[str]:
+        return list(self._stages)
+
+    @property
+    def frames(self) -> int:
+        return self._frames
+
+    @property
+    def busy_time(self) -> float:
+        """How long the last frame took without the time spent waiting for the frame cap."""
+        return self._busy_time
+
+    @property
+    def exporting(self) -> bool:
+        return self._export_file is not None
+
+    def start_export(self, file_path: str):
+        """Stream the per-frame breakdown to a json lines file until `stop_export` is called."""
+        self.stop_export()
+        self._export_file = open(file_path, "w")
+
+    def stop_export(self):
+        if self._export_file is not None:
+            self._export_file.close()
+        self._export_file = None
+
+    def _export_row(self, frame_time: float):
+        # one json object per line so that the file can be read while it is still being written
+        self._export_file.write(
+            dumps(
+                {
+                    "frame": self._frames,
+                    "frame_ms": round(frame_time * 1000, 4),
+                    "stages": {
+                        stage: round(duration * 1000, 4)
+                        for stage, duration in self._current.items()
+                    },
+                }
+            )
+            + "\n"
+        )
@@ -0,0 +1,89 @@
+from array import array
+from threading import Event, Lock, Thread
+
+import store
+from midi_file import MidiFileWriter
+
+
+class PerformanceRecorder:
+    """Records every note that is played, by the player or the auto instruments.
+
+    Each event is packed into one 64 bit integer (milliseconds since the recording started, status, note and velocity) and appended to an array, so a one hour session only takes a few megabytes.
+    A background thread swaps the array out every second and writes it to a midi file, or to a binary log of the packed events if the file doesn't end in `.mid`, so recording never waits on the disk.
+    """
+
+    def __init__(self, file_path: str, flush_interval: float = 1.0):
+        self._file_path = file_path
+        self._flush_interval = flush_interval
+        self._start = store.now()
+        self._events = array("Q")
+        # only held while appending or swapping the array, so it is never waited on for long
+        self._lock = Lock()
+        self._stopped = Event()
+        self._event_count = 0
+        if file_path.lower().endswith((".mid", ".midi")):
+            self._midi_writer = MidiFileWriter(file_path)
+            self._log_file = None
+        else:
+            self._midi_writer = None
+            self._log_file = open(file_path, "wb")
+        self._thread = Thread(target=self._run, name="RecorderThread", daemon=True)
+        self._thread.start()
+
+    def record(self, status: int, note: int, velocity: int, timestamp: float = None):
+        """Record a midi message. `timestamp` is when it should be heard in `store.now()` seconds, or now if it isn't given."""
+        if timestamp is None:
+            timestamp = store.now()
+        milliseconds = max(0, round((timestamp - self._start) * 1000))
+        with self._lock:
+            self._events.append(
+                milliseconds << 24 | status << 16 | note << 8 | velocity
+            )
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            self._flush()
+        self._flush()
+        if self._midi_writer is not None:
+            self._midi_writer.close()
+        else:
+            self._log_file.close()
+
+    def _flush(self):
+        with self._lock:
+            events, self._events = self._events, array("Q")
+        if not events:
+            return
+        # timestamps can arrive slightly out of order, and the time is in the top bits so sorting the packed events sorts them by time
+        events = array("Q", sorted(events))
+        self._event_count += len(events)
+        if self._midi_writer is not None:
+            self._midi_writer.write(
+                b"".join(
+                    self._midi_writer.encode(
+                        event >> 24, event >> 16 & 0xFF, event >> 8 & 0xFF, event & 0xFF
+                    )
+                    for event in events
+                )
+            )
+        else:
+            events.tofile(self._log_file)
+
+    def stop(self):
+        """Write the events that haven't been written yet and close the file."""
+        self._stopped.set()
+        self._thread.join()
+        print(f"Recorded {self._event_count} events to {self._file_path}")
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+
+def read_performance_log(file_path: str):
+    """Yield the events of a binary log written by `PerformanceRecorder` as `(time, status, data1, data2)` tuples, like `midi_file.read_midi_file`."""
+    events = array("Q")
+    with open(file_path, "rb") as f:
+        events.frombytes(f.read())
+    for event in events:
+        yield (event >> 24) / 1000, event >> 16 & 0xFF, event >> 8 & 0xFF, event & 0xFF
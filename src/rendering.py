@@ -1,11 +1,48 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 from math import ceil, floor
-from random import randint, random
-from time import time
 
-from pygame import Surface
+from pygame import SRCALPHA, Surface
 
 import store
 
+# horizontal position of each note in an octave, measured in white key widths
+KEY_OFFSETS = [0, 0.625, 1, 1.625, 2, 3, 3.625, 4, 4.625, 5, 5.625, 6]
+WHITE_KEY_WIDTH = 50
+BLACK_KEY_WIDTH = 37.5
+
+STEP = 1 / 60
+"""The length of one simulation step in seconds. Motion is simulated in steps of this length no matter how often frames are drawn."""
+
+
+def key_x(note: int) -> float:
+    """The x coordinate of a key's left edge, relative to the left edge of the piano."""
+    return (
+        floor(note / 12) * 7 * WHITE_KEY_WIDTH
+        + KEY_OFFSETS[note % 12] * WHITE_KEY_WIDTH
+    )
+
+
+class KeyIndex:
+    """A horizontal spatial index over the keys of a piano. Key positions are stored relative to the piano, so scrolling only changes the query and never the index."""
+
+    def __init__(self, length: int):
+        # the left edges are strictly increasing with the note number, so they can be searched with bisect
+        self._starts = [key_x(note) for note in range(length)]
+
+    def x(self, note: int) -> float:
+        return self._starts[note]
+
+    def visible(self, left: float, right: float) -> range:
+        """The notes whose keys overlap the horizontal range [left, right) in piano coordinates."""
+        # a key can start at most one white key width to the left of the range and still overlap it
+        first = bisect_right(self._starts, left - WHITE_KEY_WIDTH)
+        last = bisect_left(self._starts, right)
+        return range(first, last)
+
+    def __len__(self):
+        return len(self._starts)
+
 
 class Renderable:
     """A class that represents a renderable object. It has a position, a surface, and a sticky coordinate system."""
@@ -107,96 +144,86 @@ class Particle(Renderable):
         self._lifetime = lifetime
         self._size = size
         self._color = color
-        self._time_when_created = time()
+        self._time_when_created = store.now()
         self._surface = Surface((size, size))
         self._surface.fill(color)
         super().__init__(x, y, self._surface, 0, 1)
+        # the position before the last simulation step, used to interpolate between steps
+        self._previous_x = x
+        self._previous_y = y
 
-    def render(self, screen):
-        age = time() - self._time_when_created
-        if age > self._lifetime:
-            # .remove isn't that performant for this use case, but I'll fix it if it becomes a problem
-            store.particles.remove(self)
-            return
-        # fade out at the very end of the lifetime
-        if age > self._lifetime * 0.75:
-            self._surface.set_alpha(255 * (1 - age / self._lifetime))
-        super().render(screen)
+    @property
+    def alive(self) -> bool:
+        return store.now() - self._time_when_created <= self._lifetime
+
+    def step(self):
+        # velocity is in pixels per step and gravity is in pixels per step per step
+        self._previous_x = self._x
+        self._previous_y = self._y
         self._x += self._velocity[0]
         self._y += self._velocity[1]
         self._velocity = (self._velocity[0], self._velocity[1] + 0.2)
 
+    def render(self, screen, alpha: float = 1.0):
+        """Draw the particle `alpha` of the way between its previous and current simulated positions."""
+        age = store.now() - self._time_when_created
+        # fade out at the very end of the lifetime
+        if age > self._lifetime * 0.75:
+            self._surface.set_alpha(255 * max(0, 1 - age / self._lifetime))
+        screen.blit(
+            self._surface,
+            (
+                self._previous_x
+                + (self._x - self._previous_x) * alpha
+                + screen.get_width() * self._sticky_x,
+                self._previous_y
+                + (self._y - self._previous_y) * alpha
+                + screen.get_height() * self._sticky_y,
+            ),
+        )
 
-class NoteBar(Renderable):
-    """A moving bar that shows a note that has been played. These are children of the `PianoKey` class."""
 
-    _scroll_speed: int
-    """The speed at which the note bar moves up the screen in pixels per second."""
+class NoteBar:
+    """A note that has been played. It is drawn by the `PianoRoll` as a bar that grows up out of its key while the note is held and keeps moving up the screen after it is released."""
+
     _velocity: int
     """The velocity of the note, from 0 to 127."""
 
-    def __init__(
-        self, note: int, x: float, velocity: int, instrument: str, scroll_speed=150
-    ):
+    def __init__(self, note: int, velocity: int, instrument: str, start_row: int):
         self._note = note
-        self._scroll_speed = scroll_speed
-        self._time_when_played = time()
-        self._release_time = None
-        self._has_static_surface = False
         self._velocity = max(0, min(velocity, 127))
         self._instrument = instrument
-        super().__init__(x, 0, None, 0, 1)
+        # the piano roll rows the bar starts and ends on, the end is None while the note is held
+        self._start_row = start_row
+        self._end_row = None
+        # louder notes are more opaque
+        self._color = (
+            *store.COLOR_PALETTE[instrument + "_note_bar"],
+            min(255, self._velocity * 2),
+        )
 
-    def release(self):
-        self._release_time = time()
+    def release(self, row: int):
+        self._end_row = max(row, self._start_row)
 
-    def render(self, screen):
-        # update y position (the 230 pixel offset makes the note bar appear to be above the piano, but rounding makes 229 look better)
-        self._y = -229 - (time() - self._time_when_played) * self._scroll_speed
-
-        # calculate the height of the note bar based on if it has been released or not
-        if not self._has_static_surface:
-            if self._release_time is None:
-                height = (time() - self._time_when_played) * self._scroll_speed
-                # create a new surface with the calculated height
-                if self.is_white:
-                    self._surface = Surface((50, height))
-                else:
-                    self._surface = Surface((37.5, height))
-                # calculate the color of the note bar based on the velocity
-                self._surface.fill(store.COLOR_PALETTE[self._instrument + "_note_bar"])
-                self._surface.set_alpha(self._velocity * 2)
-                # make some particles
-                for _ in range(ceil(self._velocity / 127 * 5)):
-                    store.particles.append(
-                        Particle(
-                            self._x + random() * self._surface.get_width(),
-                            self._y + self._surface.get_height(),
-                            (
-                                randint(-4, 4) * self._velocity / 127,
-                                randint(-8, -2) * self._velocity / 127,
-                            ),
-                            0.5,
-                            3,
-                            store.COLOR_PALETTE[self._instrument + "_note_bar"],
-                        )
-                    )
-            else:
-                # this is the case where the note has been released for the first frame
-                height = (
-                    self._release_time - self._time_when_played
-                ) * self._scroll_speed
-                if self.is_white:
-                    self._surface = Surface((50, height))
-                else:
-                    self._surface = Surface((37.5, height))
-                # calculate the color of the note bar based on the velocity
-                self._surface.fill(store.COLOR_PALETTE[self._instrument + "_note_bar"])
-                self._surface.set_alpha(self._velocity * 2)
-                self._has_static_surface = True
-
-        # render the note bar
-        super().render(screen)
+    def step(self, x: float):
+        """Make some particles at the bottom of the note bar while it is held. `x` is the left edge of the bar on the screen."""
+        if self._end_row is not None:
+            return
+        width = WHITE_KEY_WIDTH if self.is_white else BLACK_KEY_WIDTH
+        for _ in range(ceil(self._velocity / 127 * 5 * store.particle_density)):
+            store.particles.append(
+                Particle(
+                    x + store.random.random() * width,
+                    -229,
+                    (
+                        store.random.randint(-4, 4) * self._velocity / 127,
+                        store.random.randint(-8, -2) * self._velocity / 127,
+                    ),
+                    0.5,
+                    3,
+                    store.COLOR_PALETTE[self._instrument + "_note_bar"],
+                )
+            )
 
     @property
     def is_white(self):
@@ -216,33 +243,153 @@ class NoteBar(Renderable):
 
     @property
     def released(self):
-        return self._release_time is not None
+        return self._end_row is not None
 
-    def scroll_x(self, amount):
-        self._x += amount
+    @property
+    def color(self):
+        return self._color
+
+    @property
+    def start_row(self):
+        return self._start_row
+
+    @property
+    def end_row(self):
+        return self._end_row
+
+
+class PianoRoll:
+    """The scrolling history of note bars above the piano.
+
+    Time is divided into rows of pixels, and the rows are stored in a tall surface that is used as a ring buffer.
+    Each row is painted once when its time comes, and every frame blits the visible window of the ring, so the cost of drawing the history doesn't depend on how many notes are in it.
+    """
+
+    _scroll_speed: int
+    """The speed at which the note bars move up the screen in pixels per second."""
+
+    def __init__(
+        self, key_index: KeyIndex, width: float, history: int = 2048, scroll_speed=150
+    ):
+        self._key_index = key_index
+        self._scroll_speed = scroll_speed
+        # the ring is in piano coordinates horizontally, and each row is 1/scroll_speed seconds of history
+        self._history = history
+        self._surface = Surface((ceil(width), history), SRCALPHA)
+        self._surface.fill((0, 0, 0, 0))
+        # the last row that has been painted, counted from the start of time rather than wrapped around the ring
+        self._head = self.row()
+        # bars that still have rows to be painted, held bars are also indexed by note and instrument to release them
+        self._note_bars: list[NoteBar] = []
+        self._held: dict[tuple[int, str], list[NoteBar]] = {}
+
+    def row(self) -> int:
+        """The row for the current time."""
+        return floor(store.now() * self._scroll_speed)
+
+    def press(self, note: int, velocity: int, instrument: str):
+        note_bar = NoteBar(note, velocity, instrument, self.row())
+        self._note_bars.append(note_bar)
+        self._held.setdefault((note, instrument), []).append(note_bar)
+
+    def release(self, note: int, instrument: str):
+        # release the oldest bar that is holding the note on the instrument
+        held = self._held.get((note, instrument))
+        if held:
+            held.pop(0).release(self.row())
+
+    def release_all(self, instrument: str):
+        row = self.row()
+        for (_, held_instrument), held in self._held.items():
+            if held_instrument == instrument:
+                for note_bar in held:
+                    note_bar.release(row)
+                held.clear()
+
+    def step(self, scroll: float, visible: range):
+        # only held bars on keys inside the viewport make particles
+        for (note, _), held in self._held.items():
+            if note in visible:
+                for note_bar in held:
+                    note_bar.step(self._key_index.x(note) + scroll)
+
+    def paint(self):
+        """Paint the rows between the last paint and now."""
+        head = self.row()
+        if head <= self._head:
+            return
+        # clear the rows that are about to be reused
+        self._fill_rows(
+            0, self._surface.get_width(), self._head + 1, head, (0, 0, 0, 0)
+        )
+        for note_bar in self._note_bars:
+            first = max(note_bar.start_row, self._head + 1)
+            last = head if note_bar.end_row is None else min(note_bar.end_row, head)
+            # very short notes get at least one row, even if they were released before they were painted
+            last = max(first, last) if note_bar.released else last
+            if last >= first:
+                x = self._key_index.x(note_bar.note)
+                width = WHITE_KEY_WIDTH if note_bar.is_white else BLACK_KEY_WIDTH
+                self._fill_rows(x, width, first, last, note_bar.color)
+        self._note_bars = [
+            note_bar
+            for note_bar in self._note_bars
+            if note_bar.end_row is None or note_bar.end_row > head
+        ]
+        self._head = head
+
+    def _fill_rows(self, x: float, width: float, first: int, last: int, color):
+        # fill the rows from first to last inclusive, wrapping around the bottom of the ring
+        count = min(last - first + 1, self._history)
+        top = (last - count + 1) % self._history
+        self._surface.fill(color, (x, top, width, min(count, self._history - top)))
+        if top + count > self._history:
+            self._surface.fill(color, (x, 0, width, top + count - self._history))
+
+    def render(self, screen, scroll: float):
+        # the newest painted row is drawn just above the keys, and older rows are drawn above it up to the top of the screen
+        bottom = screen.get_height() - 229
+        count = min(bottom, self._history)
+        if count <= 0:
+            return
+        # only blit the part of the ring that is inside the viewport
+        left = max(0, -scroll)
+        right = min(self._surface.get_width(), screen.get_width() - scroll)
+        if right <= left:
+            return
+        top = (self._head - count + 1) % self._history
+        y = bottom - count
+        first = min(count, self._history - top)
+        screen.blit(self._surface, (left + scroll, y), (left, top, right - left, first))
+        if first < count:
+            screen.blit(
+                self._surface,
+                (left + scroll, y + first),
+                (left, 0, right - left, count - first),
+            )
+
+    def __len__(self):
+        return len(self._note_bars)
+
+
+@lru_cache(maxsize=None)
+def key_surface(white: bool, color: str) -> Surface:
+    """A key filled with a color from the palette. Keys only ever change color, so every key of the same shape and color shares one surface."""
+    surface = Surface((50, 230)) if white else Surface((37.5, 142.5))
+    surface.fill(store.COLOR_PALETTE[color])
+    return surface
 
 
 class PianoKey(Renderable):
     """A piano key is a renderable that has a note associated with it."""
 
-    _children: list[NoteBar]
-
     def __init__(self, note):
         self._note = note
-        if self.is_white:
-            self._surface = Surface((50, 230))
-        else:
-            self._surface = Surface((37.5, 142.5))
-        # fill the surface with white or black, depending on the note
-        if self.is_white:
-            self._surface.fill(store.COLOR_PALETTE["light_key"])
-        else:
-            self._surface.fill(store.COLOR_PALETTE["dark_key"])
-        offsets = [0, 0.625, 1, 1.625, 2, 3, 3.625, 4, 4.625, 5, 5.625, 6]
+        # white or black, depending on the note
         super().__init__(
-            floor(note / 12) * 350 + offsets[note % 12] * 50,
+            key_x(note),
             -230,
-            self._surface,
+            key_surface(self.is_white, "light_key" if self.is_white else "dark_key"),
             0,
             1,
         )
@@ -257,20 +404,22 @@ class PianoKey(Renderable):
 
     def press(self, velocity=80):
         if self.is_white:
-            self._surface.fill(store.COLOR_PALETTE["pressed_light_key"])
+            self._surface = key_surface(True, "pressed_light_key")
         else:
-            self._surface.fill(store.COLOR_PALETTE["pressed_dark_key"])
-        self.add_child(NoteBar(self._note, self._x, velocity, "piano"))
+            self._surface = key_surface(False, "pressed_dark_key")
 
     def release(self):
         if self.is_white:
-            self._surface.fill(store.COLOR_PALETTE["light_key"])
+            self._surface = key_surface(True, "light_key")
         else:
-            self._surface.fill(store.COLOR_PALETTE["dark_key"])
-        if len(self._children) > 0:
-            self._children[-1].release()
+            self._surface = key_surface(False, "dark_key")
 
     def scroll_x(self, amount):
         self._x += amount
         for child in self._children:
             child.scroll_x(amount)
+
+    def move_to(self, x: float):
+        # move the key so that its left edge is at x
+        if x != self._x:
+            self.scroll_x(x - self._x)
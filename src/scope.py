@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class AudioScope:
+    """Keeps the latest window of audio output for the visualiser, and analyses it into a waveform and a spectrum.
+
+    The audio thread writes every block into a ring twice, once in each half, so the latest window is always one contiguous slice of the ring and can be read as a view without copying or locking.
+    The window might be half overwritten while it is being read, which only shows as a glitch in one frame.
+    """
+
+    def __init__(self, window: int = 2048, sample_rate: int = 44100, bars: int = 48):
+        self._window = window
+        self._ring = np.zeros(window * 2, np.int16)
+        # where the oldest sample of the latest window is, the newest is just before it in the other half
+        self._head = 0
+        # the window is halved before the fft by averaging pairs of samples, which is enough for the frequencies that are shown
+        self._hann = np.hanning(window // 2).astype(np.float32)
+        # the bars are spaced evenly in pitch rather than frequency, like the keys of the piano
+        frequencies = np.geomspace(40, min(16000, sample_rate / 4), bars + 1)
+        edges = np.unique(np.round(frequencies * (window // 2) / (sample_rate / 2)))
+        self._edges = np.maximum(edges.astype(np.intp), 1)
+        # the magnitude of a full scale sine wave after the window is applied
+        self._full_scale = 32768 * self._hann.sum() / 2
+
+    def __call__(self, block: bytes):
+        """Write a block of output into the ring. Called on the audio thread by the `AudioManager` tap."""
+        samples = np.frombuffer(block, np.int16)[-self._window :]
+        window = self._window
+        start = self._head
+        end = start + len(samples)
+        first = min(end, window) - start
+        self._ring[start : start + first] = samples[:first]
+        self._ring[start + window : start + window + first] = samples[:first]
+        if first < len(samples):
+            rest = len(samples) - first
+            self._ring[:rest] = samples[first:]
+            self._ring[window : window + rest] = samples[first:]
+        self._head = end % window
+
+    def latest(self) -> np.ndarray:
+        """The latest window of output, oldest sample first, as a view into the ring."""
+        return self._ring[self._head : self._head + self._window]
+
+    def waveform(self, points: int, span: int = 1024) -> np.ndarray:
+        """The last `span` samples decimated to `points` values between -1 and 1."""
+        step = max(1, span // points)
+        return self.latest()[-step * points :: step] / 32768
+
+    def spectrum(self) -> np.ndarray:
+        """The level of each bar between 0 and 1, on a 60 dB scale."""
+        samples = self.latest().reshape(-1, 2).mean(axis=1, dtype=np.float32)
+        magnitudes = np.abs(np.fft.rfft(samples * self._hann))
+        levels = np.maximum.reduceat(magnitudes, self._edges[:-1])
+        decibels = 20 * np.log10(levels / self._full_scale + 1e-9)
+        return np.clip(decibels / 60 + 1, 0, 1)
+
+    @property
+    def bars(self) -> int:
+        return len(self._edges) - 1
@@ -0,0 +1,121 @@
+"""Times the phases of starting the app.
+
+The window and the first frame come first, and everything that isn't needed to draw a frame (opening the audio device, scanning midi devices, reading assets) runs on background threads while the app starts drawing.
+When the app has drawn its first interactive frame and every phase has finished, a report of when each phase ran is printed.
+"""
+
+from contextlib import contextmanager, nullcontext
+from json import dump
+from os import scandir
+from threading import Lock, Thread, current_thread
+from time import perf_counter
+
+import store
+
+
+class Startup:
+    """Records when each phase of the startup ran and on which thread. `store.startup` is set to the instance while the app is starting."""
+
+    def __init__(self):
+        self._start = perf_counter()
+        # (name, thread, start, end) in seconds since the startup began
+        self._phases = []
+        self._running = set()
+        self._milestones = {}
+        self._lock = Lock()
+        self._reported = False
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the code in the `with` block as the phase `name`. Phases can run on any thread."""
+        with self._lock:
+            self._running.add(name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            with self._lock:
+                self._running.discard(name)
+                self._phases.append(
+                    (
+                        name,
+                        current_thread().name,
+                        start - self._start,
+                        end - self._start,
+                    )
+                )
+
+    def background(self, name: str, function, *args):
+        """Run `function(*args)` as a phase on its own thread."""
+
+        def run():
+            with self.phase(name):
+                function(*args)
+
+        with self._lock:
+            # counted as running before the thread starts, so the report waits for it
+            self._running.add(name)
+        Thread(target=run, name=f"Startup-{name}", daemon=True).start()
+
+    def milestone(self, name: str):
+        """Record that something happened, e.g. the first frame was drawn. Only the first time counts."""
+        self._milestones.setdefault(name, perf_counter() - self._start)
+
+    @property
+    def finished(self) -> bool:
+        """Whether the app is interactive and every phase has finished."""
+        return "interactive" in self._milestones and not self._running
+
+    def report(self) -> dict:
+        """Print the timings of every phase and return them."""
+        self._reported = True
+        with self._lock:
+            phases = sorted(self._phases, key=lambda phase: phase[2])
+        for name, thread, start, end in phases:
+            print(
+                f"Startup {name:<12} {start * 1000:8.1f} ms -> {end * 1000:8.1f} ms"
+                f" ({(end - start) * 1000:7.1f} ms on {thread})"
+            )
+        for name, time in self._milestones.items():
+            print(f"Startup {name:<12} {time * 1000:8.1f} ms")
+        return {
+            "phases": [
+                {
+                    "name": name,
+                    "thread": thread,
+                    "start_ms": start * 1000,
+                    "end_ms": end * 1000,
+                }
+                for name, thread, start, end in phases
+            ],
+            "milestones_ms": {
+                name: time * 1000 for name, time in self._milestones.items()
+            },
+        }
+
+    def export(self, file_path: str):
+        with open(file_path, "w") as f:
+            dump(self.report(), f, indent=2)
+
+    @property
+    def reported(self) -> bool:
+        return self._reported
+
+
+def startup_phase(name: str):
+    """Time a phase if the app is starting up, and do nothing otherwise. Used by code that also runs outside of startup."""
+    if store.startup is None:
+        return nullcontext()
+    return store.startup.phase(name)
+
+
+def read_assets(directory: str):
+    """Read every file in `directory` so that the operating system caches them before they are loaded on the main thread."""
+    for entry in scandir(directory):
+        if entry.is_dir():
+            read_assets(entry.path)
+        elif entry.is_file():
+            with open(entry.path, "rb") as f:
+                while f.read(1 << 20):
+                    pass
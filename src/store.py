@@ -1,3 +1,9 @@
+from random import Random
+from time import perf_counter
+
+from events import EventBus
+from tuning import Tuning
+
 COLOR_PALETTE = {
     "background": (216, 220, 222),
     "dark_key": (26, 77, 208),
@@ -15,10 +21,47 @@ COLOR_PALETTE = {
 screen = None
 """Holds a global reference to the screen so that we can access it from anywhere."""
 
+now = perf_counter
+"""Returns the current time in seconds. Everything that moves or is scheduled reads the time from here (as `store.now()`), so that a replay can swap in a simulated clock."""
+
+random = Random()
+"""The random number generator used by the auto instruments and the visuals. It can be seeded to make a session repeatable."""
+
+noise_random = Random()
+"""The random number generator used by the noise synth. It is separate from `random` because it is used on the audio thread."""
+
+tuning = Tuning.equal_temperament()
+"""The frequencies the synthesizers play each midi note at. Replace it to play in another tuning, it is read whenever a note starts."""
+
+event_bus = EventBus()
+"""Carries notes, midi messages and changes to the accompaniment between the threads and parts of the app. Each part drains the events it subscribed to once per frame or audio block."""
+
 scroll_offset = {"x": 0, "y": 0}
 
+frame_cap = 60
+"""The maximum number of frames drawn per second, or 0 to draw frames as fast as possible. Motion doesn't depend on it."""
+
+particle_density = 1.0
+"""How many particles the held note bars make, from 0 for none to 1 for all of them. Lowered by the load governor."""
+
+detailed_visuals = True
+"""Whether the visualiser draws the spectrum as well as the waveform. Turned off by the load governor."""
+
+autoplay_polyphony = None
+"""The most notes each auto instrument plays at once, or None for no limit. Lowered by the load governor."""
+
+audio_effects = True
+"""Whether the output goes through the compressor. Turned off by the load governor, the limiter is always on."""
+
 # the particles that are currently being rendered (used for the note bar)
 particles = []
 
 app = None
 audio_manager = None
+profiler = None
+recorder = None
+bounce = None
+input_trace = None
+startup = None
+tracer = None
+governor = None
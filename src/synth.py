@@ -1,18 +1,24 @@
 from abc import ABC, abstractmethod
+from collections import deque
 from math import pi, sin
-from queue import Queue
-from random import random
+from statistics import mean, pstdev
+from time import perf_counter
 
 import numpy as np
 import pyaudio
 
+import store
+from events import BusEvent, EventKind
 from midi import Note
+from tracer import trace_span
 
 
 class SynthVoice(ABC):
     """An abstract class that represents a synth voice. A synth voice is a single instrument that can play multiple notes at once. `get_summed_samples` returns the next samples for all the notes that are currently being played."""
 
     _freq: float = 0
+    # cycles per sample of the note being played
+    _increment: float = 0
     _sample_rate: int
     _sample_length: int
 
@@ -21,12 +27,12 @@ class SynthVoice(ABC):
         self._sample_length = sample_length
         self._phase = 0
 
-    def play(self, note: int or Note or float):
-        # if the note is an integer, convert it to a Note object
-        if note is int:
-            note = Note(note, 0)
-        # make a temporary instance of the note class to calculate the pitch of the note
-        self._freq = note.freq
+    def play(self, note: int or Note):
+        if isinstance(note, Note):
+            note = note.note
+        # the pitch comes from the tables of the current tuning, so playing a note doesn't calculate anything
+        self._freq = store.tuning.frequencies[note]
+        self._increment = store.tuning.phase_increments(self._sample_rate)[note]
 
     @abstractmethod
     def get_next_samples(self, length) -> list[float]:
@@ -35,21 +41,17 @@ class SynthVoice(ABC):
 
 class SineSynth(SynthVoice):
     def get_next_samples(self, length):
-        samples = [
-            sin(2 * pi * self._freq * (i + self._phase) / self._sample_rate)
-            for i in range(length)
-        ]
+        step = 2 * pi * self._increment
+        samples = [sin(step * (i + self._phase)) for i in range(length)]
         self._phase += length
         return samples
 
 
 class SquareSynth(SynthVoice):
     def get_next_samples(self, length):
+        step = 2 * pi * self._increment
         samples = [
-            1
-            if sin(2 * pi * self._freq * (i + self._phase) / self._sample_rate) > 0
-            else -1
-            for i in range(length)
+            1 if sin(step * (i + self._phase)) > 0 else -1 for i in range(length)
         ]
         self._phase += length
         return samples
@@ -58,8 +60,7 @@ class SquareSynth(SynthVoice):
 class SawSynth(SynthVoice):
     def get_next_samples(self, length):
         samples = [
-            2 * (self._freq * (i + self._phase) / self._sample_rate % 1 - 0.5)
-            for i in range(length)
+            2 * (self._increment * (i + self._phase) % 1 - 0.5) for i in range(length)
         ]
         self._phase += length
         return samples
@@ -68,7 +69,7 @@ class SawSynth(SynthVoice):
 class TriangleSynth(SynthVoice):
     def get_next_samples(self, length):
         samples = [
-            2 * abs(self._freq * (i + self._phase) / self._sample_rate % 1 - 0.5) - 1
+            2 * abs(self._increment * (i + self._phase) % 1 - 0.5) - 1
             for i in range(length)
         ]
         self._phase += length
@@ -77,7 +78,7 @@ class TriangleSynth(SynthVoice):
 
 class NoiseSynth(SynthVoice):
     def get_next_samples(self, length):
-        samples = [random() * 2 - 1 for i in range(length)]
+        samples = [store.noise_random.random() * 2 - 1 for i in range(length)]
         self._phase += length
         return samples
 
@@ -136,6 +137,10 @@ class AdsrEnvelope(Processor):
     def release(self):
         self._released_samples = 0
 
+    @property
+    def released(self):
+        return self._released_samples is not None
+
     def process(self, samples: list):
         return [sample * self.value for sample in samples]
 
@@ -171,60 +176,192 @@ class AdsrEnvelope(Processor):
         return value * self._amp
 
 
+# how long after its timestamp a note is heard. a note can be handed to the audio thread up to this long after its timestamp, or any time before it, and still start at its exact frame
+SCHEDULING_LATENCY = 0.02
+
+
+class SampleClock:
+    """Maps host timestamps (`store.now()` seconds) onto frames of the audio output, so that a note can start at the exact frame within a block that matches when it was played.
+
+    Every timestamp is delayed by the same `latency`, which keeps the spacing between notes intact as long as they reach the audio thread within that time.
+    """
+
+    def __init__(self, sample_rate: int, latency: float = SCHEDULING_LATENCY):
+        self._sample_rate = sample_rate
+        self._latency = latency
+        # the host time that the start of the current block corresponds to
+        self._block_time = None
+        self._block_length = 0
+        # how late each timestamped note was started compared to when it was played, in seconds
+        self._latencies = deque(maxlen=1000)
+
+    def begin_block(self, frame_count: int, now: float = None):
+        now = store.now() if now is None else now
+        if self._block_time is None:
+            self._block_time = now
+        else:
+            expected = self._block_time + self._block_length / self._sample_rate
+            # callbacks are called with some jitter, so only follow the measured time slowly unless the stream has stalled
+            if abs(now - expected) > 0.05:
+                self._block_time = now
+            else:
+                self._block_time = expected + (now - expected) * 0.05
+        self._block_length = frame_count
+
+    def offset(self, timestamp: float = None) -> int:
+        """The number of frames from the start of the current block to when an event with this timestamp should be heard."""
+        if timestamp is None or self._block_time is None:
+            return 0
+        offset = max(
+            0,
+            round((timestamp + self._latency - self._block_time) * self._sample_rate),
+        )
+        self._latencies.append(
+            self._block_time + offset / self._sample_rate - timestamp
+        )
+        return offset
+
+    def latency_stats(self) -> dict:
+        """The mean, jitter (standard deviation) and maximum time between a note being played and it starting in the output, in milliseconds."""
+        latencies = list(self._latencies)
+        if not latencies:
+            return {"count": 0, "mean_ms": 0.0, "jitter_ms": 0.0, "max_ms": 0.0}
+        return {
+            "count": len(latencies),
+            "mean_ms": mean(latencies) * 1000,
+            "jitter_ms": pstdev(latencies) * 1000,
+            "max_ms": max(latencies) * 1000,
+        }
+
+
+class PlayingNote:
+    """A note that an `InstrumentAudio` is playing, with its own synth voice and envelope."""
+
+    def __init__(self, note: Note, voice: SynthVoice, envelope: AdsrEnvelope):
+        self.note = note
+        self.voice = voice
+        self.envelope = envelope
+        # the number of frames until the note starts and until it is released, counted from the start of the next block
+        self.start_delay = 0
+        self.release_delay = None
+
+    def get_next_samples(self, length: int) -> list[float]:
+        start = min(self.start_delay, length)
+        self.start_delay -= start
+        samples = [0.0] * start
+        if start == length:
+            # the release is counted down while the note waits to start, so it still happens at its own frame
+            if self.release_delay is not None:
+                self.release_delay = max(0, self.release_delay - length)
+            return samples
+        # a release that was timestamped before the note started happens as soon as it starts
+        release = None
+        if self.release_delay is not None:
+            release = max(start, min(self.release_delay, length))
+            self.release_delay = (
+                None if release < length else self.release_delay - length
+            )
+        voice_samples = self.voice.get_next_samples(length - start)
+        if release is None or release == length:
+            return samples + self.envelope.process(voice_samples)
+        samples += self.envelope.process(voice_samples[: release - start])
+        self.envelope.release()
+        return samples + self.envelope.process(voice_samples[release - start :])
+
+    @property
+    def is_dead(self):
+        return self.start_delay == 0 and self.envelope.is_dead
+
+
 class InstrumentAudio:
     """A class that manages all the notes for a synth voice. This is semi-analogous to an instrument in a DAW."""
 
-    # FIXME this datatype isn't very OOP of me
-    _notes: list[(Note, SynthVoice, AdsrEnvelope)]
+    _notes: list[PlayingNote]
 
-    def __init__(self, synth_voice, envelope_values: tuple[float, float, float, float]):
+    def __init__(
+        self,
+        synth_voice,
+        envelope_values: tuple[float, float, float, float],
+        channel: int = 0,
+    ):
         self._notes = []
-        self._press_queue = Queue()
-        self._release_queue = Queue()
+        # the midi channel the instrument's notes are recorded on
+        self._channel = channel
+        # the note events for this instrument that the audio manager has taken off the bus for the next block, in the order they were published
+        self._pending_events = []
         self._synth_voice = synth_voice
         self._envelope_values = envelope_values
 
-    def play(self, note: Note):
-        self._press_queue.put(note)
+    def play(self, note: Note, timestamp: float = None):
+        """Play a note. If a host timestamp is given, the note starts at the frame that matches it."""
+        store.event_bus.publish(
+            BusEvent(
+                EventKind.NOTE_ON, self._channel, note.note, note.velocity, timestamp
+            )
+        )
+        if store.recorder is not None:
+            store.recorder.record(
+                0x90 | self._channel, note.note, note.velocity, timestamp
+            )
 
-    def release(self, note: Note or int):
+    def release(self, note: Note or int, timestamp: float = None):
         """Take in either a `Note` object or a midi key number."""
         if type(note) == Note:
-            note = Note.note
-        self._release_queue.put(note)
-
-    def release_all(self):
-        for note in self._notes:
-            self._release_queue.put(note[0].note)
-
-    def get_next_samples(self, length: int):
-        while self._press_queue.qsize():
-            note: Note = self._press_queue.get()
-            self._notes.append(
-                (
+            note = note.note
+        store.event_bus.publish(
+            BusEvent(EventKind.NOTE_OFF, self._channel, note, 0, timestamp)
+        )
+        if store.recorder is not None:
+            store.recorder.record(0x80 | self._channel, note, 0, timestamp)
+
+    def release_all(self, timestamp: float = None):
+        """Release every note the instrument is playing."""
+        store.event_bus.publish(
+            BusEvent(EventKind.ALL_NOTES_OFF, self._channel, timestamp=timestamp)
+        )
+        if store.recorder is not None:
+            # the notes that are playing belong to the audio thread, so the midi "all notes off" controller is recorded instead of a note off for each of them
+            store.recorder.record(0xB0 | self._channel, 123, 0, timestamp)
+
+    def queue_event(self, event: BusEvent):
+        """Called by the audio manager on the audio thread with the events of this instrument's channel."""
+        self._pending_events.append(event)
+
+    @property
+    def channel(self) -> int:
+        return self._channel
+
+    def get_next_samples(self, length: int, clock: SampleClock = None):
+        events, self._pending_events = self._pending_events, []
+        for kind, _, note, velocity, timestamp, _ in events:
+            if kind == EventKind.NOTE_ON:
+                note = Note(note, velocity)
+                playing_note = PlayingNote(
                     note,
-                    (
-                        self._synth_voice
-                    )(),  # call the synth voice class to create a new instance
+                    self._synth_voice(),  # call the synth voice class to create a new instance
                     AdsrEnvelope(*self._envelope_values, note.velocity / 127),
                 )
-            )
-            self._notes[-1][1].play(note)
-
-        # FIXME bug with releasing notes where notes can get stuck as pressed
-        while self._release_queue.qsize():
-            note = self._release_queue.get()
-            for i in range(len(self._notes)):
-                if self._notes[i][0].note == note:
-                    self._notes[i][2].release()
+                playing_note.voice.play(note)
+                if clock is not None:
+                    playing_note.start_delay = clock.offset(timestamp)
+                self._notes.append(playing_note)
+                continue
+            for playing_note in self._notes:
+                if (
+                    (kind == EventKind.ALL_NOTES_OFF or playing_note.note.note == note)
+                    and playing_note.release_delay is None
+                    and not playing_note.envelope.released
+                ):
+                    playing_note.release_delay = (
+                        0 if clock is None else clock.offset(timestamp)
+                    )
 
         # remove dead notes
-        self._notes = [note for note in self._notes if not note[2].is_dead]
+        self._notes = [note for note in self._notes if not note.is_dead]
 
         samples = [0] * length
-        for i in range(len(self._notes)):
-            note_samples = self._notes[i][1].get_next_samples(length)
-            note_samples = self._notes[i][2].process(note_samples)
+        for playing_note in self._notes:
+            note_samples = playing_note.get_next_samples(length)
             samples = [samples[i] + note_samples[i] for i in range(length)]
         return samples
 
@@ -237,30 +374,54 @@ class AudioManager:
 
     _compressor = Compressor(0.5, 5)
 
-    def __init__(self):
+    def __init__(self, output: bool = True):
+        """If `output` is False no audio device is opened, and samples are only made by calling `render`."""
         self._sample_rate = 44100
         self._length = 256
         self._instrument_audios = []
+        # the instruments by the channel their notes are published on, every instrument needs a channel of its own
+        self._channels: dict[int, InstrumentAudio] = {}
+        # the audio engine only takes notes off the event bus while something renders it, see `_subscribe`
+        self._events = None
         self._max_sample = 0.0
-        self._p = pyaudio.PyAudio()
-        self._stream = self._p.open(
-            output=True, format=pyaudio.paInt16, channels=1, rate=self._sample_rate
-        )
+        # maps the timestamps of notes onto the frames of the output
+        self._clock = SampleClock(self._sample_rate)
+        self._output = output
+        # the audio device is only opened by `start`, which can take a while so it doesn't hold up the first frame
+        self._p = None
+        self._stream = None
+        if not output:
+            # without a device the owner calls `render` itself
+            self._subscribe()
+        # called with every block of output, replaced as a whole so that the audio thread never sees it half changed
+        self._taps = ()
+        # how much of the time between blocks it took to render each of the last few blocks, and how many blocks were late
+        self._loads = deque(maxlen=64)
+        self._underflows = 0
         # self._waveform = []
 
     def add_instrument_audio(self, instrument_audio: InstrumentAudio):
         self._instrument_audios.append(instrument_audio)
+        self._channels[instrument_audio.channel] = instrument_audio
+
+    def add_tap(self, tap):
+        """Call `tap(block)` with every block of output as it is rendered, on the audio thread. Taps have to return quickly and must not wait on anything."""
+        self._taps = self._taps + (tap,)
+
+    def remove_tap(self, tap):
+        self._taps = tuple(other for other in self._taps if other is not tap)
 
     def get_next_samples(self, count: int):
         samples = [0] * count
         for synth in self._instrument_audios:
             synth: InstrumentAudio
-            synth_samples = synth.get_next_samples(count)
+            synth_samples = synth.get_next_samples(count, self._clock)
             samples = [samples[i] + synth_samples[i] for i in range(count)]
 
         # Global FX chain:
-        # compressor
-        samples = self._compressor.process(samples)
+        # compressor, which is skipped when the load governor needs the time
+        if store.audio_effects:
+            samples = self._compressor.process(samples)
         # dynamic limiter
         samples = [min(max(sample, -5), 5) for sample in samples]
 
@@ -270,15 +431,81 @@ class AudioManager:
 
         return samples
 
+    def render(self, frame_count: int) -> bytes:
+        """The next block of output as 16 bit mono pcm."""
+        self._clock.begin_block(frame_count)
+        if self._events is None:
+            self._subscribe()
+        # the notes played since the last block are handed to their instruments in one go
+        events = self._events.drain()
+        if store.tracer is not None:
+            store.tracer.counter("audio events", len(events))
+        for event in events:
+            instrument_audio = self._channels.get(event.data1)
+            if instrument_audio is not None:
+                instrument_audio.queue_event(event)
+        block = np.int16(self.get_next_samples(frame_count)).tobytes()
+        for tap in self._taps:
+            tap(block)
+        return block
+
     def callback(self, in_data, frame_count, time_info, status):
-        samples = self.get_next_samples(frame_count)
-        return (np.int16(samples).tobytes(), pyaudio.paContinue)
+        start = perf_counter()
+        with trace_span("audio callback"):
+            block = self.render(frame_count)
+        self._loads.append((perf_counter() - start) * self._sample_rate / frame_count)
+        if status & pyaudio.paOutputUnderflow:
+            self._underflows += 1
+        return (block, pyaudio.paContinue)
+
+    def _subscribe(self):
+        self._events = store.event_bus.subscribe(
+            "audio", EventKind.NOTE_ON, EventKind.NOTE_OFF, EventKind.ALL_NOTES_OFF
+        )
 
     def start(self):
-        self._stream = self._p.open(
-            format=pyaudio.paInt16,
-            channels=1,
-            rate=44100,
-            output=True,
-            stream_callback=self.callback,
+        if not self._output or self._stream is not None:
+            return
+        self._p = pyaudio.PyAudio()
+        # notes only queue up for the audio thread while there is a device to play them, so they don't pile up if opening it fails
+        self._subscribe()
+        try:
+            self._stream = self._p.open(
+                format=pyaudio.paInt16,
+                channels=1,
+                rate=44100,
+                output=True,
+                # small blocks keep the time between a note being played and it reaching the audio thread short
+                frames_per_buffer=self._length,
+                stream_callback=self.callback,
+            )
+        except Exception:
+            store.event_bus.unsubscribe(self._events)
+            self._events = None
+            raise
+
+    def latency_stats(self) -> dict:
+        """How long notes take from being played to being heard. The scheduling latency and jitter are measured per note, and the output latency is what the audio device reports."""
+        stats = self._clock.latency_stats()
+        stats["output_ms"] = (
+            self._stream.get_output_latency() * 1000 if self._stream else 0.0
         )
+        return stats
+
+    @property
+    def clock(self) -> SampleClock:
+        return self._clock
+
+    @property
+    def load(self) -> float:
+        """The most of the time between blocks that rendering one of the last few blocks took. Above 1 the audio can't keep up."""
+        return max(self._loads, default=0.0)
+
+    @property
+    def underflows(self) -> int:
+        """How many times the audio device ran out of samples because a block was late."""
+        return self._underflows
+
+    @property
+    def sample_rate(self) -> int:
+        return self._sample_rate
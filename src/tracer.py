@@ -0,0 +1,102 @@
+"""Traces what every thread is doing on one timeline, in the Chrome trace event format.
+
+The trace can be opened in https://ui.perfetto.dev or chrome://tracing to see e.g. the midi thread reading a note, the main thread drawing it and the audio thread starting it.
+Tracing is off unless `store.tracer` is set, e.g. with `python src/main.py --trace FILE`, and `trace_span` does nothing while it is off.
+"""
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from json import dump
+from os import getpid
+from threading import Lock, current_thread, local
+from time import perf_counter
+
+import store
+
+
+class Tracer:
+    """Records spans, counters and instants into a buffer per thread. Only the thread that owns a buffer appends to it, so recording doesn't take a lock."""
+
+    def __init__(self, capacity: int = 1 << 16):
+        # the most events kept per thread, the oldest ones are dropped first
+        self._capacity = capacity
+        self._local = local()
+        # (thread name, thread id, buffer) of every thread that has recorded something
+        self._buffers: list[tuple[str, int, deque]] = []
+        # only taken the first time a thread records something
+        self._lock = Lock()
+
+    def _buffer(self) -> deque:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = deque(maxlen=self._capacity)
+            thread = current_thread()
+            with self._lock:
+                self._buffers.append((thread.name, thread.native_id, buffer))
+        return buffer
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """Record the code in the `with` block as a span on the current thread."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, perf_counter(), args or None)
+
+    def complete(self, name: str, start: float, end: float, args: dict = None):
+        """Record a span that has already ended, from `time.perf_counter` times."""
+        # events are kept as tuples of (phase, name, time, duration or value, args) until they are saved
+        self._buffer().append(("X", name, start, end - start, args))
+
+    def counter(self, name: str, value: float):
+        self._buffer().append(("C", name, perf_counter(), value, None))
+
+    def instant(self, name: str, **args):
+        self._buffer().append(("i", name, perf_counter(), None, args or None))
+
+    def save(self, file_path: str):
+        """Write every buffered event to a json file, which can be done while the other threads are still recording."""
+        pid = getpid()
+        events = []
+        with self._lock:
+            buffers = list(self._buffers)
+        for thread_name, tid, buffer in buffers:
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+            )
+            # copying a deque is a single operation, so it can't see an event being appended halfway
+            for phase, name, time, value, args in buffer.copy():
+                event = {
+                    "name": name,
+                    "ph": phase,
+                    "ts": time * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                }
+                if phase == "X":
+                    event["dur"] = value * 1e6
+                elif phase == "C":
+                    args = {name: value}
+                else:
+                    # instants are drawn on their own thread rather than across the whole process
+                    event["s"] = "t"
+                if args:
+                    event["args"] = args
+                events.append(event)
+        with open(file_path, "w") as f:
+            dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print(f"Saved a trace of {len(events)} events to {file_path}")
+
+
+def trace_span(name: str, **args):
+    """Trace a span if tracing is on, and do nothing otherwise."""
+    if store.tracer is None:
+        return nullcontext()
+    return store.tracer.span(name, **args)
@@ -0,0 +1,80 @@
+"""Frequency tables for the 128 midi notes.
+
+A tuning works out the frequency of every note once, so playing a note is a table lookup. Besides equal temperament with any A4, tunings can be loaded from MIDI Tuning Standard bulk dumps (`.syx` files).
+"""
+
+
+class TuningError(Exception):
+    pass
+
+
+class Tuning:
+    """The frequency of every midi note, and the phase increment of every note at each sample rate it has been asked for."""
+
+    def __init__(self, frequencies: list[float], name: str = "custom"):
+        if len(frequencies) != 128:
+            raise TuningError("A tuning needs a frequency for each of the 128 notes")
+        self._frequencies = tuple(float(frequency) for frequency in frequencies)
+        self._name = name
+        self._phase_increments: dict[int, tuple[float, ...]] = {}
+
+    @classmethod
+    def equal_temperament(cls, a4: float = 440.0) -> "Tuning":
+        # https://en.wikipedia.org/wiki/MIDI_tuning_standard
+        return cls(
+            [a4 * 2 ** ((note - 69) / 12) for note in range(128)],
+            f"12-TET, A4 = {a4:g} Hz",
+        )
+
+    @classmethod
+    def from_mts_bulk_dump(cls, data: bytes, base: "Tuning" = None) -> "Tuning":
+        """Read a MIDI Tuning Standard bulk tuning dump (F0 7E <device> 08 01 <program> <16 byte name> <128 x 3 bytes> <checksum> F7).
+
+        Each note is tuned to a semitone plus a 14 bit fraction of the next semitone. Notes marked as unchanged (7F 7F 7F) keep their frequency from `base`, which defaults to equal temperament.
+        """
+        if (
+            len(data) < 408
+            or data[0] != 0xF0
+            or data[1] != 0x7E
+            or data[3:5] != b"\x08\x01"
+            or data[407] != 0xF7
+        ):
+            raise TuningError("Not a MIDI Tuning Standard bulk dump")
+        # the checksum is the exclusive or of every byte from 7E to the end of the tuning data
+        checksum = 0
+        for byte in data[1:406]:
+            checksum ^= byte
+        if checksum & 0x7F != data[406]:
+            raise TuningError("The checksum of the bulk dump doesn't match")
+        name = data[6:22].decode("ascii", "replace").strip() or "MTS"
+        frequencies = list((base or cls.equal_temperament()).frequencies)
+        for note in range(128):
+            semitone, msb, lsb = data[22 + note * 3 : 25 + note * 3]
+            if (semitone, msb, lsb) == (0x7F, 0x7F, 0x7F):
+                continue
+            fraction = (msb << 7 | lsb) / 16384
+            frequencies[note] = 440 * 2 ** ((semitone + fraction - 69) / 12)
+        return cls(frequencies, name)
+
+    @classmethod
+    def from_file(cls, file_path: str) -> "Tuning":
+        with open(file_path, "rb") as f:
+            return cls.from_mts_bulk_dump(f.read())
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def frequencies(self) -> tuple[float, ...]:
+        return self._frequencies
+
+    def phase_increments(self, sample_rate: int) -> tuple[float, ...]:
+        """How many cycles of each note pass per sample at `sample_rate`."""
+        increments = self._phase_increments.get(sample_rate)
+        if increments is None:
+            increments = tuple(
+                frequency / sample_rate for frequency in self._frequencies
+            )
+            self._phase_increments[sample_rate] = increments
+        return increments
@@ -1,12 +1,45 @@
-from pygame import MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION, surface
+from functools import lru_cache
+from time import strftime, time
+
+import numpy as np
+from pygame import (
+    K_F3,
+    K_F4,
+    K_F7,
+    KEYDOWN,
+    MOUSEBUTTONDOWN,
+    MOUSEBUTTONUP,
+    MOUSEMOTION,
+)
+from pygame import Surface, draw, surface
 from pygame.event import Event
 from pygame.font import Font
 
+from profiler import FrameProfiler
 from rendering import Renderable
+from scope import AudioScope
 
 import store
 
 
+@lru_cache(maxsize=None)
+def get_font(face: str, size: int) -> Font:
+    """Load a font from the fonts folder. Fonts are shared by every widget, so each face and size is only read from disk once."""
+    return Font(f"assets/fonts/{face}", size)
+
+
+@lru_cache(maxsize=256)
+def render_text(
+    face: str,
+    size: int,
+    text: str,
+    color: tuple[int, int, int] = (0, 0, 0),
+    background: tuple[int, int, int] = (255, 255, 255),
+) -> Surface:
+    """Render a line of text, reusing the surface if the same text has been rendered recently. The returned surface is shared, so it must not be drawn on."""
+    return get_font(face, size).render(text, True, color, background)
+
+
 class UiBase(Renderable):
     def process_event(self, event: Event):
         pass
@@ -22,17 +55,20 @@ class UiText(UiBase):
         text,
         font: str = "SofiaSans-Regular.ttf",
     ):
-        # draw the text to a surface
         self._text = text
         self._font = font
+        # the text is drawn to a surface the first time it is needed, so that creating widgets doesn't load fonts
+        super().__init__(x, y, None, sticky_x, sticky_y)
 
-        font = Font(f"assets/fonts/{font}", 24)
-
-        self._surface = font.render(self._text, True, (0, 0, 0), (255, 255, 255))
-
-        super().__init__(x, y, self._surface, sticky_x, sticky_y)
-
-    def render(self, surface: surface.Surface):
+    @property
+    def surface(self) -> Surface:
+        if self._surface is None:
+            self._surface = render_text(self._font, 24, self._text)
+        return self._surface
+
+    def render(self, surface: Surface):
+        # make sure the text has been rendered
+        self.surface
         super().render(surface)
 
     @property
@@ -43,10 +79,9 @@ class UiText(UiBase):
     def text(self, value):
         if self._text == value:  # don't bother rendering if the text hasn't changed
             return
-        # update the text
+        # update the text, it is rendered when it is next drawn
         self._text = value
-        font = Font(f"assets/fonts/{self._font}", 24)
-        self._surface = font.render(self._text, True, (0, 0, 0), (255, 255, 255))
+        self._surface = None
 
 
 def default_callback():
@@ -71,9 +106,9 @@ class UiButton(UiText):
         if event.type == MOUSEBUTTONDOWN:
             if (
                 event.pos[0] > self.screenspace_x
-                and event.pos[0] < self.screenspace_x + self._surface.get_width()
+                and event.pos[0] < self.screenspace_x + self.surface.get_width()
                 and event.pos[1] > self.screenspace_y
-                and event.pos[1] < self.screenspace_y + self._surface.get_height()
+                and event.pos[1] < self.screenspace_y + self.surface.get_height()
             ):
                 self._callback()
 
@@ -84,3 +119,119 @@ class UiButton(UiText):
     @property
     def screenspace_y(self):
         return self.y + self.sticky_y * store.screen.get_height()
+
+
+class UiProfilerOverlay(UiBase):
+    """Shows the rolling p50/p95/p99 timings of each frame stage. F3 toggles the overlay and F4 toggles streaming the per-frame breakdown to a file."""
+
+    def __init__(
+        self,
+        x,
+        y,
+        sticky_x,
+        sticky_y,
+        profiler: FrameProfiler,
+        font: str = "SofiaSans-Regular.ttf",
+    ):
+        self._profiler = profiler
+        self._font = font
+        self._visible = False
+        self._last_update = 0.0
+        super().__init__(x, y, Surface((1, 1)), sticky_x, sticky_y)
+
+    def process_event(self, event: Event):
+        if event.type != KEYDOWN:
+            return
+        if event.key == K_F3:
+            self._visible = not self._visible
+            self._last_update = 0.0
+        elif event.key == K_F4:
+            if self._profiler.exporting:
+                self._profiler.stop_export()
+                print("Stopped exporting frame profile")
+            else:
+                file_path = f"profile-{strftime('%Y%m%d-%H%M%S')}.jsonl"
+                self._profiler.start_export(file_path)
+                print(f"Exporting frame profile to {file_path}")
+
+    def render(self, surface: Surface):
+        if not self._visible:
+            return
+        # sorting the samples isn't free, so only refresh the numbers a couple of times a second
+        if time() - self._last_update > 0.5:
+            self._last_update = time()
+            self._update_surface()
+        super().render(surface)
+
+    def _update_surface(self):
+        lines = ["stage  p50 / p95 / p99 ms"]
+        for stage in [None] + self._profiler.stages:
+            p50, p95, p99 = self._profiler.percentiles(stage)
+            lines.append(
+                f"{stage or 'frame'}  {p50 * 1000:.2f} / {p95 * 1000:.2f} / {p99 * 1000:.2f}"
+            )
+        # how many events per second go through the event bus, and how many each consumer keeps up with
+        for name, rate in store.event_bus.throughput().items():
+            lines.append(f"{name}  {rate:.0f}/s")
+        if self._profiler.exporting:
+            lines.append("exporting")
+        # the numbers change every time, so these lines skip the shared text cache
+        font = get_font(self._font, 16)
+        rendered = [
+            font.render(line, True, (0, 0, 0), (255, 255, 255)) for line in lines
+        ]
+        self._surface = Surface(
+            (
+                max(line.get_width() for line in rendered),
+                sum(line.get_height() for line in rendered),
+            )
+        )
+        self._surface.fill((255, 255, 255))
+        y = 0
+        for line in rendered:
+            self._surface.blit(line, (0, y))
+            y += line.get_height()
+
+
+class UiVisualiser(UiBase):
+    """Draws the spectrum and waveform of the audio output from an `AudioScope`. F7 shows and hides it.
+
+    It is hidden until it is shown, and see-through, because wherever it is it covers part of the piano roll.
+    """
+
+    def __init__(
+        self, x, y, sticky_x, sticky_y, scope: AudioScope, width=320, height=120
+    ):
+        self._scope = scope
+        self._visible = False
+        super().__init__(x, y, Surface((width, height)), sticky_x, sticky_y)
+        # the note bars behind it still show through
+        self._surface.set_alpha(160)
+
+    def process_event(self, event: Event):
+        if event.type == KEYDOWN and event.key == K_F7:
+            self._visible = not self._visible
+
+    def render(self, surface: Surface):
+        if not self._visible:
+            return
+        width, height = self._surface.get_size()
+        self._surface.fill(store.COLOR_PALETTE["light_key"])
+        # the spectrum is a bar chart behind the waveform
+        if store.detailed_visuals:
+            levels = self._scope.spectrum()
+            bar_width = width / len(levels)
+            color = store.COLOR_PALETTE["chords_note_bar"]
+            for i, top in enumerate((height * (1 - levels)).tolist()):
+                self._surface.fill(
+                    color, (i * bar_width, top, bar_width - 1, height - top)
+                )
+        # the waveform is drawn with one line per pixel, in a single call
+        samples = self._scope.waveform(width // 2)
+        points = np.empty((len(samples), 2))
+        points[:, 0] = np.arange(len(samples)) * 2
+        points[:, 1] = height / 2 - samples * height / 2
+        draw.lines(
+            self._surface, store.COLOR_PALETTE["dark_key"], False, points.tolist()
+        )
+        super().render(surface)